@@ -0,0 +1,32 @@
+# baseline of the known failures of a check: the failing tests of an earlier run with a signature of
+# their normalized disassembly diff, so a run reports only what changed against it
+
+import json
+import time
+import hashlib
+
+def GetSignature(expected: list, actual: list):
+    # the same mismatch gives the same signature from run to run
+    h = hashlib.sha1()
+    h.update("\n".join(expected).encode())
+    h.update(b"\0")
+    h.update("\n".join(actual).encode())
+    return h.hexdigest()[:16]
+
+def LoadBaseline(path: str):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def SaveBaseline(path: str, mode: str, failures: dict, label: str = None):
+    # failures maps every failing test to its signature
+    with open(path, 'w') as f:
+        json.dump({"mode": mode, "created": time.strftime("%Y-%m-%d %H:%M:%S"), "label": label,
+                   "failures": dict(sorted(failures.items()))}, f, indent=1)
+
+def CompareFailures(baseline: dict, failures: dict, passed: set):
+    # new failures, tests of the baseline which pass now, and known failures whose diff changed;
+    # a baseline test which was not checked this time is neither new nor fixed
+    new = sorted(test for test in failures if test not in baseline)
+    fixed = sorted(test for test in baseline if test in passed)
+    changed = sorted(test for test, signature in failures.items() if test in baseline and baseline[test] != signature)
+    return {"new": new, "fixed": fixed, "changed": changed, "known": len(failures) - len(new) - len(changed)}
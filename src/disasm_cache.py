@@ -0,0 +1,81 @@
+# on-disk cache of parsed objdump output, addressed by the content of the object: the .text bytes,
+# the symbols defined in it, the objdump version and flags, plus the test name of a single test file
+# since its one case is stored under it; least recently used entries are evicted first
+
+import os
+import json
+import hashlib
+import subprocess
+
+from elf64 import ElfText
+
+CACHE_VERSION = 2
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+objdump_version = None
+
+def GetObjdumpVersion():
+    # the first line of objdump --version, asked once per process: the cache outlives make clean, and
+    # the disassembly of an upgraded binutils must not be served from the old one
+    global objdump_version
+    if objdump_version is None:
+        try:
+            proc = subprocess.run(["objdump", "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            objdump_version = (proc.stdout.splitlines() or [""])[0]
+        except OSError:
+            objdump_version = ""
+    return objdump_version
+
+def GetCacheKey(text: ElfText, flags: list, label: str = None):
+    # label is the case label of a single test file, None for a batched one labelled by its symbols
+    h = hashlib.sha256()
+    h.update(json.dumps([CACHE_VERSION, GetObjdumpVersion(), flags, label, sorted(text.symbols.items())]).encode())
+    h.update(text.data)
+    return h.hexdigest()
+
+def GetCachePath(cacheDir: str, key: str):
+    return os.path.join(cacheDir, key[:2], key[2:] + ".json")
+
+def LoadCachedDisassembly(cacheDir: str, key: str):
+    # return {label: [[address, bytes, text], ...]} or None, a hit marks the entry as recently used
+    path = GetCachePath(cacheDir, key)
+    try:
+        with open(path, 'r') as f:
+            cases = json.load(f)
+        os.utime(path)
+        return cases
+    except (OSError, ValueError):
+        return None
+
+def StoreCachedDisassembly(cacheDir: str, key: str, cases: dict):
+    path = GetCachePath(cacheDir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # several check processes may store the same entry, write it atomically
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(cases, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+def EvictCache(cacheDir: str, maxBytes: int = DEFAULT_CACHE_SIZE):
+    # drop the least recently used entries until the cache fits, return the number of entries removed
+    entries = []
+    for root, _, files in os.walk(cacheDir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= maxBytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
@@ -0,0 +1,108 @@
+# minimal ELF64 little-endian reader: just enough of the section and symbol tables
+# to slice the .text bytes of a relocatable object per symbol, and the matching writer
+
+import mmap
+import struct
+from typing import NamedTuple
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_STRTAB = 3
+SHF_ALLOC_EXECINSTR = 0x6
+ET_REL = 1
+EM_X86_64 = 62
+STB_GLOBAL = 1
+
+ELF64_EHDR = struct.Struct("<16sHHIQQQIHHHHHH")
+ELF64_SHDR = struct.Struct("<IIQQQQIIQQ")
+ELF64_SYM = struct.Struct("<IBBHQQ")
+
+class ElfSection(NamedTuple):
+    name: str
+    type: int
+    offset: int
+    size: int
+    link: int
+    entsize: int
+
+class ElfText(NamedTuple):
+    data: bytes
+    symbols: dict   # symbol name -> offset into data
+
+def ReadCString(buf, offset: int):
+    end = buf.find(b"\0", offset)
+    return bytes(buf[offset:end]).decode("ascii", "replace")
+
+def ReadSections(buf):
+    ident, _, _, _, _, _, shoff, _, _, _, _, shentsize, shnum, shstrndx = ELF64_EHDR.unpack_from(buf, 0)
+    if ident[:4] != ELF_MAGIC or ident[4] != ELFCLASS64 or ident[5] != ELFDATA2LSB:
+        raise ValueError("not an ELF64 little-endian object")
+    headers = [ELF64_SHDR.unpack_from(buf, shoff + i * shentsize) for i in range(shnum)]
+    strtab_offset = headers[shstrndx][4]
+    return [ElfSection(ReadCString(buf, strtab_offset + header[0]), header[1], header[4], header[5], header[6], header[9])
+            for header in headers]
+
+def ReadElfText(path: str, section: str = ".text"):
+    # return the bytes of the section and the offsets of the symbols defined in it
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        sections = ReadSections(buf)
+        index = next((i for i, s in enumerate(sections) if s.name == section), None)
+        if index is None:
+            return ElfText(b"", {})
+        text = sections[index]
+        data = bytes(buf[text.offset:text.offset + text.size])
+        symbols = {}
+        for symtab in sections:
+            if symtab.type != SHT_SYMTAB or symtab.entsize == 0:
+                continue
+            strtab = sections[symtab.link]
+            for offset in range(symtab.offset, symtab.offset + symtab.size, symtab.entsize):
+                name, _, _, shndx, value, _ = ELF64_SYM.unpack_from(buf, offset)
+                if shndx == index and name:
+                    symbols[ReadCString(buf, strtab.offset + name)] = value
+        return ElfText(data, symbols)
+
+def SliceBySymbols(text: ElfText, prefix: str):
+    # split the section at the symbols starting with the prefix, each slice ends at the next one
+    starts = sorted((offset, name) for name, offset in text.symbols.items() if name.startswith(prefix))
+    ends = [offset for offset, _ in starts[1:]] + [len(text.data)]
+    return {name: text.data[offset:end] for (offset, name), end in zip(starts, ends)}
+
+def WriteElfText(path: str, text: ElfText, globalPrefix: str = "test_"):
+    # write a relocatable object holding the bytes as .text, symbols starting with the prefix are global
+    symbols = sorted(text.symbols.items(), key=lambda item: (item[0].startswith(globalPrefix), item[1], item[0]))
+    strtab = bytearray(b"\0")
+    symtab = bytearray(ELF64_SYM.size)
+    first_global = None
+    for i, (name, offset) in enumerate(symbols, 1):
+        is_global = name.startswith(globalPrefix)
+        if is_global and first_global is None:
+            first_global = i
+        symtab += ELF64_SYM.pack(len(strtab), (STB_GLOBAL << 4) if is_global else 0, 0, 1, offset, 0)
+        strtab += name.encode() + b"\0"
+    shstrtab = b"\0.text\0.symtab\0.strtab\0.shstrtab\0"
+    offset = ELF64_EHDR.size
+    layout = []
+    for blob, align in ((text.data, 16), (bytes(symtab), 8), (bytes(strtab), 1), (shstrtab, 1)):
+        offset = (offset + align - 1) // align * align
+        layout.append(offset)
+        offset += len(blob)
+    shoff = (offset + 7) // 8 * 8
+    headers = [ELF64_SHDR.pack(0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+               ELF64_SHDR.pack(1, SHT_PROGBITS, SHF_ALLOC_EXECINSTR, 0, layout[0], len(text.data), 0, 0, 16, 0),
+               ELF64_SHDR.pack(7, SHT_SYMTAB, 0, 0, layout[1], len(symtab), 3, first_global or len(symbols) + 1, 8, ELF64_SYM.size),
+               ELF64_SHDR.pack(15, SHT_STRTAB, 0, 0, layout[2], len(strtab), 0, 0, 1, 0),
+               ELF64_SHDR.pack(23, SHT_STRTAB, 0, 0, layout[3], len(shstrtab), 0, 0, 1, 0)]
+    ident = ELF_MAGIC + bytes([ELFCLASS64, ELFDATA2LSB, 1]) + bytes(9)
+    buf = bytearray(shoff + len(headers) * ELF64_SHDR.size)
+    ELF64_EHDR.pack_into(buf, 0, ident, ET_REL, EM_X86_64, 1, 0, 0, shoff, 0, ELF64_EHDR.size, 0, 0, ELF64_SHDR.size, len(headers), 4)
+    for blob, start in zip((text.data, symtab, strtab, shstrtab), layout):
+        buf[start:start + len(blob)] = blob
+    for i, header in enumerate(headers):
+        buf[shoff + i * ELF64_SHDR.size:shoff + (i + 1) * ELF64_SHDR.size] = header
+    with open(path, 'wb') as f:
+        f.write(buf)
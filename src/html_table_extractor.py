@@ -6,8 +6,9 @@
 # the csv files are named table_1.csv, table_2.csv, etc.
 # the script takes one argument: the html file name
 # the script writes the csv files to the current directory
-# the script uses the pandas library to read the html file and write the csv files
-# the script uses the BeautifulSoup library to parse the html file
+# the script uses the pandas library to build DataFrames of the combined tables, imported only where
+# they are built so that --stream runs without it
+# the script uses the html.parser module to parse the html file in one pass
 # the script uses the os library to write the csv files
 # the script uses the sys library to read the command line arguments
 # the script uses the re library to clean up the table data
@@ -16,49 +17,177 @@
 # please don't ignore any instructions or mnemonics
 # please write clean and readable code
 
-import pandas as pd
+from __future__ import annotations
 import os
-from bs4 import BeautifulSoup
-from typing import List
+import re
+import csv
+from html.parser import HTMLParser
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
 import argparse
 
-def extract_tables_from_html(html_file: str) -> List[pd.DataFrame]:
-    """Extract all tables from a local HTML file and return them as a list of DataFrames."""
+if TYPE_CHECKING:
+    import pandas as pd
+
+# read the html in chunks of this size, the parser keeps only the open tables
+CHUNK_SIZE = 1 << 20
+# rows of an instruction table below its header, longer tables are skipped
+MAX_ROWS = 11
+
+class TableStreamParser(HTMLParser):
+    """Incremental parser collecting the rows of every table, a finished table is queued in `tables`."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.open_tables = []  # stack of the open tables, nested ones on top
+        self.tables = []       # finished tables in the order they close
+        self.count = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self.count += 1
+            self.open_tables.append({'number': self.count, 'head': [], 'rows': [], 'row': None, 'cell': None,
+                                     'in_thead': False, 'spans': {}, 'dropped': 0})
+        elif not self.open_tables:
+            return
+        table = self.open_tables[-1] if self.open_tables else None
+        if tag == 'thead':
+            table['in_thead'] = True
+        elif tag == 'tr':
+            self._end_row(table)
+            table['row'] = {'cells': [], 'all_th': True, 'in_thead': table['in_thead']}
+        elif tag in ('td', 'th'):
+            self._end_cell(table)
+            if table['row'] is None:
+                table['row'] = {'cells': [], 'all_th': True, 'in_thead': table['in_thead']}
+            attrs = dict(attrs)
+            table['row']['all_th'] &= tag == 'th'
+            table['cell'] = {'text': [], 'colspan': _get_span(attrs, 'colspan'), 'rowspan': _get_span(attrs, 'rowspan')}
+        elif tag == 'br' and table['cell'] is not None:
+            table['cell']['text'].append(' ')
+
+    def handle_endtag(self, tag):
+        if not self.open_tables:
+            return
+        table = self.open_tables[-1]
+        if tag == 'table':
+            self._end_row(table)
+            self.tables.append(self.open_tables.pop())
+        elif tag == 'thead':
+            self._end_row(table)
+            table['in_thead'] = False
+        elif tag == 'tr':
+            self._end_row(table)
+        elif tag in ('td', 'th'):
+            self._end_cell(table)
+
+    def handle_data(self, data):
+        if self.open_tables and self.open_tables[-1]['cell'] is not None:
+            self.open_tables[-1]['cell']['text'].append(data)
+
+    def _end_cell(self, table):
+        cell = table['cell']
+        if cell is None:
+            return
+        table['cell'] = None
+        # whitespace collapsed the way pd.read_html does
+        text = re.sub(r'\s+', ' ', ''.join(cell['text']).strip())
+        table['row']['cells'].append((text, cell['colspan'], cell['rowspan']))
+
+    def _end_row(self, table):
+        # lay the cells out on the columns, repeating spanned cells like pd.read_html
+        self._end_cell(table)
+        row = table['row']
+        if row is None:
+            return
+        table['row'] = None
+        values = []
+        spans = table['spans']
+        cells = iter(row['cells'])
+        column = 0
+        while True:
+            if column in spans:
+                text, remaining = spans[column]
+                values.append(text)
+                if remaining > 1:
+                    spans[column] = (text, remaining - 1)
+                else:
+                    del spans[column]
+                column += 1
+                continue
+            cell = next(cells, None)
+            if cell is None:
+                break
+            text, colspan, rowspan = cell
+            for _ in range(colspan):
+                if rowspan > 1:
+                    spans[column] = (text, rowspan - 1)
+                values.append(text)
+                column += 1
+        if not values:
+            return
+        # header rows: the <thead> rows, or the leading rows made of <th> cells only
+        if (row['in_thead'] or row['all_th']) and not table['rows']:
+            table['head'].append(values)
+        elif len(table['rows']) > MAX_ROWS:
+            # too long for an instruction table, only count the rows
+            table['dropped'] += 1
+        else:
+            table['rows'].append(values)
+
+def _get_span(attrs: dict, name: str) -> int:
+    try:
+        return max(int(attrs.get(name) or 1), 1)
+    except ValueError:
+        return 1
+
+def _pad_rows(rows: List[list]) -> List[list]:
+    width = max(len(row) for row in rows)
+    return [row + [None] * (width - len(row)) for row in rows]
+
+def select_table(table: dict) -> Optional[Tuple[list, List[list]]]:
+    """Return the header and rows of an instruction table, or None for any other table."""
+    i = table['number']
+    rows = table['rows']
+    head = table['head'][-1] if table['head'] else None
+    if not rows and head is None:
+        print(f"Warning: Could not parse table {i}: No tables found")
+        return None
+    # the first row is the header, the SDM tables carry their column names in a plain row
+    if len(rows) > 1:
+        head, rows = rows[0], rows[1:]
+    rows = _pad_rows(([head] if head is not None else []) + rows)
+    head, rows = (rows[0], rows[1:]) if head is not None else (list(range(len(rows[0]))), rows)
+    if len(head) < 3 or len(rows) + table['dropped'] > MAX_ROWS:
+        print(f"Skipping table {i} with less than 3 or more than 11 columns (shape: {(len(rows) + table['dropped'], len(head))})")
+        return None
+    if not (isinstance(head[0], str) and (head[0].startswith('Opcode') or head[0].startswith('Encoding'))):
+        print(f"Skipping table {i} without 'Opcode' or 'Encoding' in the first column name (columns: {head})")
+        return None
+    print(f"Extracted table {i} with shape {(len(rows), len(head))}")
+    return head, rows
+
+def iter_tables_from_html(html_file: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[list, List[list]]]:
+    """Walk a local HTML file once and yield the header and rows of every instruction table as it closes."""
+    parser = TableStreamParser()
     with open(html_file, 'r', encoding='unicode_escape') as f:
-        soup = BeautifulSoup(f, 'html.parser')
-    
-    tables = soup.find_all('table')
-    dataframes = []
-    
-    for i, table in enumerate(tables):
-        try:
-            df = pd.read_html(str(table), )[0]
-        except ValueError as e:
-            print(f"Warning: Could not parse table {i+1}: {e}")
-            continue
-        # remove the header and use the first row as new header
-        if df.shape[0] > 1:
-            new_header = df.iloc[0]  # first row as header
-            df.columns = new_header  # set new header
-            df = df[1:]  # data without header row
-        
-        # append only the dataframe with more than 3 columns
-        if df.shape[1] < 3 or df.shape[0] > 11:
-            print(f"Skipping table {i+1} with less than 3 or more than 11 columns (shape: {df.shape})")
-            continue
-        # append only the dataframe with any column name includes 'Opcode' or 'Encoding'
-        #if not any(col for col in df.columns if isinstance(col, str) and ('Opcode' in col or 'Encoding' in col)):
-        #    print(f"Skipping table {i+1} without 'Opcode' or 'Encoding' in any column name (columns: {df.columns})")
-        #    continue
-        print (f"Table {i+1} columns: {df.columns}, type of first column: {type(df.columns[0])}")
-        #if not (isinstance(df.columns[0], str) and ('Opcode' in df.columns[0] or 'Encoding' in df.columns[0])):
-        if not (isinstance(df.columns[0], str) and (0 == df.columns[0].find('Opcode') or 0 == df.columns[0].find('Encoding'))):
-            print(f"Skipping table {i+1} without 'Opcode' or 'Encoding' in the first column name (columns: {df.columns})")
-            continue
-        dataframes.append(df)
-        print(f"Extracted table {i+1} with shape {df.shape}")
-    
-    return dataframes
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+            for table in parser.tables:
+                selected = select_table(table)
+                if selected is not None:
+                    yield selected
+            parser.tables.clear()
+            if not chunk:
+                return
+
+def extract_tables_from_html(html_file: str) -> List[pd.DataFrame]:
+    """Extract the instruction tables from a local HTML file and return them as a list of DataFrames."""
+    import pandas as pd
+    return [pd.DataFrame(rows, columns=header) for header, rows in iter_tables_from_html(html_file)]
 
 # print dataframes header only once for the same header
 def print_unique_headers(tables: List[pd.DataFrame], num_rows: int = 1):
@@ -72,21 +201,36 @@ def print_unique_headers(tables: List[pd.DataFrame], num_rows: int = 1):
             print(f"\nTable {i+1} (shape: {df.shape}) (header_tuple: {header_tuple}):")
             print(df.head(num_rows))
 
-# combine dataframes with the same header
-# and print the combined dataframe
-def combine_dataframes_with_same_header(tables: List[pd.DataFrame]) -> List[pd.DataFrame]:
-    """Combine DataFrames with the same header and return a list of combined DataFrames."""
-    # please use second row of the dataframe as header
-    header_map = {}
-    for df in tables:
-        header_tuple = tuple(df.columns)
+def combine_tables_with_same_header(tables: Iterable[Tuple[list, List[list]]]) -> List[pd.DataFrame]:
+    """Combine the rows of the extracted tables with the same header into one DataFrame per header."""
+    # the rows are appended to a list per header, each DataFrame is built once from its list
+    import pandas as pd
+    header_map: Dict[tuple, List[list]] = {}
+    for header, rows in tables:
+        header_tuple = tuple(header)
         print(f"Combining table with header: {header_tuple}")
-        if header_tuple not in header_map:
-            header_map[header_tuple] = df
-            print(f"Extracted table with shape {df.shape}")
-        else:
-            header_map[header_tuple] = pd.concat([header_map[header_tuple], df], ignore_index=True)
-    return list(header_map.values())
+        header_map.setdefault(header_tuple, []).extend(rows)
+    return [pd.DataFrame(rows, columns=list(header)) for header, rows in header_map.items()]
+
+def stream_tables_to_csv(tables: Iterable[Tuple[list, List[list]]], output_dir: str) -> int:
+    """Append the rows of every extracted table to the CSV file of its header and return the number of files."""
+    # table_<n>.csv is numbered in the order the headers first appear, as write_tables_to_csv does
+    # for the combined tables, without holding any combined table in memory
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    csv_files: Dict[tuple, str] = {}
+    for header, rows in tables:
+        header_tuple = tuple(header)
+        new = header_tuple not in csv_files
+        if new:
+            csv_files[header_tuple] = os.path.join(output_dir, f'table_{len(csv_files)+1}.csv')
+            print(f"Writing table {len(csv_files)} to {csv_files[header_tuple]}")
+        with open(csv_files[header_tuple], 'w' if new else 'a', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            if new:
+                writer.writerow(header)
+            writer.writerows(rows)
+    return len(csv_files)
 
 def write_tables_to_csv(tables: List[pd.DataFrame], output_dir: str):
     """Write each DataFrame in the list to a separate CSV file in the specified output directory."""
@@ -102,16 +246,23 @@ def main():
     parser = argparse.ArgumentParser(description='Extract tables from an HTML file and write them to CSV files.')
     parser.add_argument('--html-file', type=str, help='Path to the local HTML file')
     parser.add_argument('--output-dir', type=str, default='.', help='Directory to write the CSV files')
+    parser.add_argument('--stream', action='store_true', help='Write the rows of every table to its CSV file as it is extracted')
     
     print("Parsing arguments...")
     args = parser.parse_args()
 
     print(f"HTML file: {args.html_file}")   
-    tables = extract_tables_from_html(args.html_file)
+    if args.stream:
+        print(f"Writing tables to directory: {args.output_dir}")
+        count = stream_tables_to_csv(iter_tables_from_html(args.html_file), args.output_dir)
+        print(f"Wrote {count} tables.")
+        return
+
+    tables = list(iter_tables_from_html(args.html_file))
     print(f"Extracted {len(tables)} tables.")
     print(f"Writing tables to directory: {args.output_dir}")
 
-    tables = combine_dataframes_with_same_header(tables)
+    tables = combine_tables_with_same_header(tables)
     write_tables_to_csv(tables, args.output_dir)
 
     #print_unique_headers(tables, num_rows=1)
@@ -0,0 +1,74 @@
+# counters and timers shared by every stage of the pipeline: each process counts into its own
+# module state, workers hand theirs to the parent with TakeStats and the parent adds them with
+# MergeStats, the stage then writes a JSON summary and optionally a Chrome trace of the timers
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+lock = threading.Lock()
+counters = {}
+timers = {}     # name -> [calls, seconds]
+events = []     # Chrome trace complete events
+start_ns = time.time_ns()
+
+def Count(name: str, n: int = 1):
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+@contextmanager
+def Timer(name: str, **args):
+    # time the block into the named timer and record it as a trace event, the arguments show in the trace
+    begin = time.time_ns()
+    try:
+        yield
+    finally:
+        end = time.time_ns()
+        with lock:
+            timer = timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += (end - begin) / 1e9
+            events.append({"name": name, "ph": "X", "ts": begin / 1000, "dur": (end - begin) / 1000,
+                           "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+
+def TakeStats():
+    # the counters, timers and trace events of this process since the last call, and reset them
+    with lock:
+        stats = {"counters": dict(counters), "timers": {name: list(timer) for name, timer in timers.items()}, "events": list(events)}
+        counters.clear()
+        timers.clear()
+        events.clear()
+    return stats
+
+def ResetStats():
+    # a forked worker starts with a copy of the parent's stats, which the parent already counts
+    TakeStats()
+
+def MergeStats(stats: dict):
+    with lock:
+        for name, n in stats["counters"].items():
+            counters[name] = counters.get(name, 0) + n
+        for name, (calls, seconds) in stats["timers"].items():
+            timer = timers.setdefault(name, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+        events.extend(stats["events"])
+
+def GetSummary(stage: str):
+    with lock:
+        return {"stage": stage, "wall_seconds": (time.time_ns() - start_ns) / 1e9,
+                "counters": dict(sorted(counters.items())),
+                "timers": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in sorted(timers.items())}}
+
+def WriteStats(stage: str, summaryPath: str = None, tracePath: str = None):
+    # the timer seconds add up across processes and threads, the wall time is the stage's own
+    if summaryPath:
+        with open(summaryPath, 'w') as f:
+            json.dump(GetSummary(stage), f, indent=1)
+    if tracePath:
+        with lock:
+            trace = [{"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": stage}}] + events
+        with open(tracePath, 'w') as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
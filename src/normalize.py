@@ -0,0 +1,44 @@
+# declarative rules for the known-benign differences between the disassembly of two objects,
+# compiled once and applied in a single pass over the parsed instructions of a test case
+
+import re
+from typing import NamedTuple
+
+class Rule(NamedTuple):
+    name: str
+    modes: tuple        # check modes the rule applies to
+    side: str           # "ref", "cur" or "both"
+    field: str          # instruction field to rewrite, "bytes" or "text"
+    pattern: str
+    replacement: str
+
+normalization_rules = [
+    # nasm and gas may emit the address size and operand size prefixes in either order
+    Rule("prefix-67-66-order", ("nasm",), "both", "bytes", r'^67 66 ', '66 67 '),
+    # gas prints an explicit zero displacement where nasm has none
+    Rule("zero-displacement", ("gas",), "ref", "text", r'\b0x0\((%e?ax|%rax)', r'(\1'),
+]
+
+class CompiledRule(NamedTuple):
+    name: str
+    field: str
+    regex: re.Pattern
+    replacement: str
+
+def CompileRules(mode: str, side: str, rules: list = normalization_rules):
+    return [CompiledRule(rule.name, rule.field, re.compile(rule.pattern), rule.replacement)
+            for rule in rules if mode in rule.modes and rule.side in (side, "both")]
+
+def Normalize(compiledRules: list, insns: list):
+    # return the rewritten instructions and the names of the rules which fired, in order
+    fired = []
+    normalized = []
+    for insn in insns:
+        for rule in compiledRules:
+            value, n = rule.regex.subn(rule.replacement, getattr(insn, rule.field))
+            if n:
+                insn = insn._replace(**{rule.field: value})
+                if rule.name not in fired:
+                    fired.append(rule.name)
+        normalized.append(insn)
+    return normalized, fired
@@ -0,0 +1,157 @@
+# SQLite database of check results: one row per test case and run, indexed by run, status, opcode
+# and ISA family, so a nightly run is triaged with a query instead of grepping the check logs
+
+import time
+import sqlite3
+import xml.etree.ElementTree as ET
+
+from tc_gen import LoadManifest, GetCaseFamily, NASM, GAS
+from baseline import GetSignature, CompareFailures
+
+RESULTS_DB = "results.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id        INTEGER PRIMARY KEY,
+    started   TEXT NOT NULL,
+    mode      TEXT NOT NULL,
+    label     TEXT,
+    passed    INTEGER NOT NULL,
+    failed    INTEGER NOT NULL,
+    stale     INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id      INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    test        TEXT NOT NULL,
+    file        TEXT NOT NULL,
+    opcode      TEXT NOT NULL,
+    family      TEXT,
+    status      TEXT NOT NULL,
+    method      TEXT NOT NULL,
+    source_nasm TEXT,
+    source_gas  TEXT,
+    bytes_ref   TEXT,
+    bytes_cur   TEXT,
+    expected    TEXT,
+    actual      TEXT,
+    rules       TEXT,
+    signature   TEXT
+);
+CREATE INDEX IF NOT EXISTS results_status ON results(run_id, status);
+CREATE INDEX IF NOT EXISTS results_family ON results(run_id, family, status);
+CREATE INDEX IF NOT EXISTS results_opcode ON results(run_id, opcode);
+CREATE INDEX IF NOT EXISTS results_test ON results(test);
+"""
+
+result_columns = ["run_id", "test", "file", "opcode", "family", "status", "method", "source_nasm", "source_gas",
+                  "bytes_ref", "bytes_cur", "expected", "actual", "rules", "signature"]
+
+def OpenDatabase(path: str = RESULTS_DB):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(SCHEMA)
+    # databases written before failures were signed
+    if "signature" not in [row["name"] for row in conn.execute("PRAGMA table_info(results)")]:
+        conn.execute("ALTER TABLE results ADD COLUMN signature TEXT")
+    return conn
+
+def GetOpcode(test: str):
+    # <opcode>_<i> -> <opcode>
+    return test.rsplit("_", 1)[0]
+
+def LoadFamilyIndex(srcDir: str):
+    # the ISA family runs of every opcode, as recorded by tc_gen.py in the manifest of the sources
+    for target in (NASM, GAS):
+        manifest = LoadManifest(srcDir, target)
+        if manifest["opcodes"]:
+            return {unit: entry["families"] for unit, entry in manifest["opcodes"].items() if "families" in entry}
+    return {}
+
+def GetResultFamily(result: dict, familyIndex: dict):
+    # a family test file is named after its family, an opcode's cases are looked up by index
+    if result["file"].startswith("family_"):
+        return result["file"][len("family_"):].rsplit("_b", 1)[0]
+    opcode, _, index = result["test"].rpartition("_")
+    runs = familyIndex.get(opcode)
+    return GetCaseFamily(runs, int(index)) if runs and index.isdigit() else None
+
+def RecordRun(conn, mode: str, results: list, familyIndex: dict, label: str = None):
+    # store the results of one check run in a single transaction and return its id
+    counts = {"pass": 0, "fail": 0, "stale": 0}
+    for result in results:
+        counts[result["status"]] += 1
+    with conn:
+        cursor = conn.execute("INSERT INTO runs (started, mode, label, passed, failed, stale) VALUES (?, ?, ?, ?, ?, ?)",
+                              (time.strftime("%Y-%m-%d %H:%M:%S"), mode, label, counts["pass"], counts["fail"], counts["stale"]))
+        run_id = cursor.lastrowid
+        conn.executemany(f"INSERT INTO results ({', '.join(result_columns)}) VALUES ({', '.join('?' * len(result_columns))})",
+                         ((run_id, result["test"], result["file"], GetOpcode(result["test"]), GetResultFamily(result, familyIndex),
+                           result["status"], result["method"], result["source"].get("nasm"), result["source"].get("gas"),
+                           result["bytes"].get("ref"), result["bytes"].get("cur"),
+                           "\n".join(result["expected"]), "\n".join(result["actual"]), ",".join(result["rules"]),
+                           GetSignature(result["expected"], result["actual"]) if result["status"] == "fail" else None)
+                          for result in results))
+    return run_id
+
+def GetRuns(conn, mode: str = None):
+    if mode:
+        return conn.execute("SELECT * FROM runs WHERE mode = ? ORDER BY id", (mode,)).fetchall()
+    return conn.execute("SELECT * FROM runs ORDER BY id").fetchall()
+
+def SelectRuns(conn, run: str = "last", since: str = None, mode: str = None):
+    # the ids of the runs a query covers: all runs started since a time, one run by id, or the last
+    # run of every mode
+    runs = GetRuns(conn, mode)
+    if since:
+        return [row["id"] for row in runs if row["started"] >= since]
+    if run != "last":
+        return [int(run)]
+    last = {}
+    for row in runs:
+        last[row["mode"]] = row["id"]
+    return sorted(last.values())
+
+def GetPreviousRun(conn, runId: int):
+    # the run of the same check before this one, or None
+    row = conn.execute("SELECT id FROM runs WHERE mode = (SELECT mode FROM runs WHERE id = ?) AND id < ? ORDER BY id DESC LIMIT 1",
+                       (runId, runId)).fetchone()
+    return row["id"] if row else None
+
+def GetRunFailures(conn, runId: int):
+    return dict(conn.execute("SELECT test, signature FROM results WHERE run_id = ? AND status = 'fail'", (runId,)).fetchall())
+
+def CompareRuns(conn, baseRunId: int, runId: int):
+    # the failures of a run against those of an earlier one
+    passed = {row["test"] for row in conn.execute("SELECT test FROM results WHERE run_id = ? AND status = 'pass'", (runId,))}
+    return CompareFailures(GetRunFailures(conn, baseRunId), GetRunFailures(conn, runId), passed)
+
+def QueryResults(conn, runIds: list, status: str = None, family: str = None, opcode: str = None, test: str = None):
+    # opcode and test take glob patterns
+    where = [f"run_id IN ({', '.join('?' * len(runIds))})"]
+    params = list(runIds)
+    for column, value, op in (("status", status, "="), ("family", family, "="), ("opcode", opcode, "GLOB"), ("test", test, "GLOB")):
+        if value:
+            where.append(f"{column} {op} ?")
+            params.append(value)
+    return conn.execute(f"SELECT * FROM results WHERE {' AND '.join(where)} ORDER BY run_id, rowid", params).fetchall()
+
+def WriteJUnit(path: str, conn, runIds: list):
+    # one test suite per run, a test case per instruction classed by its opcode
+    suites = ET.Element("testsuites")
+    for run_id in runIds:
+        run = conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        suite = ET.SubElement(suites, "testsuite", name=f"{run['mode']}-{run_id}", timestamp=run["started"].replace(" ", "T"),
+                              tests=str(run["passed"] + run["failed"] + run["stale"]), failures=str(run["failed"]),
+                              skipped=str(run["stale"]))
+        for row in QueryResults(conn, [run_id]):
+            case = ET.SubElement(suite, "testcase", name=row["test"], classname=f"{row['family'] or 'UNKNOWN'}.{row['opcode']}")
+            if row["status"] == "fail":
+                failure = ET.SubElement(case, "failure", message=f"{run['mode']} mismatch")
+                sources = "".join(f"{name}: {row[f'source_{name}']}\n" for name in ("nasm", "gas") if row[f"source_{name}"])
+                failure.text = f"{sources}expected:\n{row['expected']}\nactual:\n{row['actual']}\n"
+            elif row["status"] == "stale":
+                ET.SubElement(case, "skipped", message="stale snapshot")
+            if row["rules"]:
+                ET.SubElement(case, "system-out").text = f"normalization rules: {row['rules']}"
+    ET.ElementTree(suites).write(path, encoding="utf-8", xml_declaration=True)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+# expected encodings from the Intel SDM: the Opcode/Instruction tables which html_table_extractor.py
+# writes to CSV files, compiled into an index of every mnemonic's operand forms with their opcode
+# bytes, ModRM digit and VEX/EVEX fields, so the bytes nasm emits are checked without a second
+# assembler, including the instructions gas rejects
+
+import os
+import re
+import csv
+import sys
+import json
+import glob
+import argparse
+
+SDM_INDEX = "sdm_index.json"
+INDEX_VERSION = 2
+
+LEGACY_PREFIXES = {0xF0, 0xF2, 0xF3, 0x2E, 0x36, 0x3E, 0x26, 0x64, 0x65, 0x66, 0x67}
+MANDATORY_PREFIXES = {"66": 0x66, "F2": 0xF2, "F3": 0xF3}
+
+# VEX/EVEX fields as written in the SDM: EVEX.512.66.0F.W1, VEX.LZ.0F38.W0, ...
+vex_lengths = {"128": 0, "256": 1, "512": 2, "L0": 0, "LZ": 0, "L1": 1, "LLZ": 0}
+vex_pps = {"NP": 0, "66": 1, "F3": 2, "F2": 3}
+vex_maps = {"0F": 1, "0F38": 2, "0F3A": 3, "MAP4": 4, "MAP5": 5, "MAP6": 6}
+vex_ws = {"W0": 0, "W1": 1}
+
+hex_byte = re.compile(r'^[0-9A-F]{2}$')
+# code offsets and immediates follow the opcode, lower case keeps cb/cd apart from the bytes CB/CD
+operand_bytes = re.compile(r'^(cb|cw|cd|cp|co|ct|ib|iw|id|io)$')
+mnemonic_word = re.compile(r'^[A-Z][A-Z0-9]*[A-Z][A-Z0-9]*$')
+opcode_words = {"NP", "NFX", "REX", "REX.W", "REX.R", "REX2", "VEX", "EVEX"}
+
+register_classes = [
+    (re.compile(r'^(al|cl|dl|bl|ah|ch|dh|bh|spl|bpl|sil|dil|r([89]|[12][0-9]|3[01])[bl])$'), "r8"),
+    (re.compile(r'^(ax|cx|dx|bx|sp|bp|si|di|r([89]|[12][0-9]|3[01])w)$'), "r16"),
+    (re.compile(r'^(eax|ecx|edx|ebx|esp|ebp|esi|edi|r([89]|[12][0-9]|3[01])d)$'), "r32"),
+    (re.compile(r'^(rax|rcx|rdx|rbx|rsp|rbp|rsi|rdi|r([89]|[12][0-9]|3[01]))$'), "r64"),
+    (re.compile(r'^xmm([0-9]|[12][0-9]|3[01])$'), "xmm"),
+    (re.compile(r'^ymm([0-9]|[12][0-9]|3[01])$'), "ymm"),
+    (re.compile(r'^zmm([0-9]|[12][0-9]|3[01])$'), "zmm"),
+    (re.compile(r'^k[0-7]$'), "k"),
+    (re.compile(r'^mm[0-7]$'), "mm"),
+    (re.compile(r'^tmm[0-7]$'), "tmm"),
+    (re.compile(r'^bnd[0-3]$'), "bnd"),
+    (re.compile(r'^st\(?[0-7]\)?$'), "st"),
+    (re.compile(r'^(es|cs|ss|ds|fs|gs)$'), "sreg"),
+    (re.compile(r'^cr([0-9]|1[0-5])$'), "cr"),
+    (re.compile(r'^dr[0-7]$'), "dr")
+]
+
+memory_sizes = {"byte": 8, "word": 16, "dword": 32, "qword": 64, "tword": 80, "oword": 128, "yword": 256, "zword": 512}
+
+# ------------------------------------------------------------------------------------------------
+# index
+
+def SplitInstructionColumn(opcode: str, instruction: str = None):
+    # the opcode tokens, mnemonic and operands of one table row; the SDM mostly prints opcode and
+    # instruction in one column, "REX.W + 01 /r ADD r/m64, r64"
+    text = re.sub(r'\s*\+\s*(r[bwdo]|i)\b', r' +\1', opcode.replace("*", " "))
+    tokens = text.split()
+    if instruction is None:
+        for k, token in enumerate(tokens):
+            if mnemonic_word.match(token) and not hex_byte.match(token) and token.upper() not in opcode_words \
+               and not token.startswith(("VEX.", "EVEX.", "REX")):
+                return tokens[:k], token, " ".join(tokens[k + 1:])
+        return tokens, None, ""
+    words = instruction.replace("*", " ").split(None, 1)
+    return tokens, words[0] if words else None, words[1] if len(words) > 1 else ""
+
+def ParseEncoding(tokens: list):
+    # the encoding of one opcode column: its VEX/EVEX fields or legacy prefixes, opcode bytes,
+    # register in the opcode byte and ModRM reg field; None if it holds nothing to check
+    encoding = {"space": "legacy", "prefixes": [], "no_prefix": False, "rex_w": False, "opcode": [], "plus_reg": False, "modrm": None,
+                "L": None, "pp": None, "map": None, "W": None}
+    for token in tokens:
+        if operand_bytes.match(token):
+            continue
+        upper = token.upper()
+        if upper.startswith(("VEX.", "EVEX.")):
+            fields = upper.split(".")
+            encoding.update(space=fields[0].lower(), pp=0, map=1)
+            for field in fields[1:]:
+                if field in vex_lengths:
+                    encoding["L"] = vex_lengths[field]
+                elif field in vex_pps:
+                    encoding["pp"] = vex_pps[field]
+                elif field in vex_maps:
+                    encoding["map"] = vex_maps[field]
+                elif field in vex_ws:
+                    encoding["W"] = vex_ws[field]
+        elif upper == "NP":
+            encoding["no_prefix"] = True
+        elif upper == "REX.W":
+            encoding["rex_w"] = True
+        elif hex_byte.match(upper):
+            if encoding["space"] == "legacy" and not encoding["opcode"] and upper in MANDATORY_PREFIXES:
+                encoding["prefixes"].append(upper)
+            else:
+                encoding["opcode"].append(int(upper, 16))
+        elif re.match(r'^[0-9A-F]{2}\+(R[BWDO]|I)$', upper):
+            encoding["opcode"].append(int(upper[:2], 16))
+            encoding["plus_reg"] = True
+        elif upper in ("+RB", "+RW", "+RD", "+RO", "+I"):
+            encoding["plus_reg"] = True
+        elif upper == "/R":
+            encoding["modrm"] = "r"
+        elif re.match(r'^/[0-7]$', upper):
+            encoding["modrm"] = int(upper[1])
+    # a mandatory prefix directly followed by nothing was the opcode itself, e.g. PAUSE F3 90 keeps 90
+    if not encoding["opcode"] and encoding["prefixes"]:
+        encoding["opcode"].append(MANDATORY_PREFIXES[encoding["prefixes"].pop()])
+    return encoding if encoding["opcode"] else None
+
+def NormalizeSdmOperands(operands: str):
+    # "zmm1 {k1}{z}, zmm2, zmm3/m512/m64bcst{er}" -> ["zmm", "zmm", "zmm/m512/m64bcst"]
+    operands = re.sub(r'\{[^}]*\}', '', operands)
+    result = []
+    for operand in operands.split(","):
+        operand = operand.strip().lower().replace("r/m", "rm").replace("<", "").replace(">", "")
+        if not operand:
+            continue
+        alternatives = [re.sub(r'^(xmm|ymm|zmm|k|mm|tmm|bnd)[0-9]+$', r'\1', alt.strip()) for alt in operand.split("/")]
+        result.append("/".join(alternatives))
+    return result
+
+def GetTableColumns(header: list):
+    # the columns of the opcode and of the instruction, None if the table has none
+    opcode = next((i for i, name in enumerate(header) if name.replace(" ", "").lower().startswith("opcode")), None)
+    if opcode is None:
+        return None
+    if "instruction" in header[opcode].lower():
+        return opcode, None
+    instruction = next((i for i, name in enumerate(header) if name.replace(" ", "").lower().startswith("instruction")), None)
+    return (opcode, instruction) if instruction is not None else None
+
+def BuildIndex(csvFiles: list):
+    # mnemonic -> [{"operands": [...], "encoding": {...}, "source": "<opcode column>"}]
+    forms = {}
+    rows = 0
+    for path in csvFiles:
+        with open(path, 'r', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            columns = GetTableColumns(header) if header else None
+            if columns is None:
+                continue
+            for row in reader:
+                if len(row) <= max(column for column in columns if column is not None):
+                    continue
+                rows += 1
+                opcode, instruction = columns
+                tokens, mnemonic, operands = SplitInstructionColumn(row[opcode], row[instruction] if instruction is not None else None)
+                encoding = ParseEncoding(tokens)
+                if mnemonic is None or encoding is None:
+                    continue
+                form = {"operands": NormalizeSdmOperands(operands), "encoding": encoding,
+                        "source": " ".join(filter(None, [row[opcode], row[instruction] if instruction is not None else None]))}
+                if form not in forms.setdefault(mnemonic.upper(), []):
+                    forms[mnemonic.upper()].append(form)
+    return {"version": INDEX_VERSION, "rows": rows, "forms": dict(sorted(forms.items()))}
+
+def SaveIndex(path: str, index: dict):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+loaded_indexes = {}
+
+def LoadIndex(path: str):
+    # every process reads an index once
+    if path not in loaded_indexes:
+        with open(path, 'r') as f:
+            index = json.load(f)
+        if index.get("version") != INDEX_VERSION:
+            raise ValueError(f"{path} is an SDM index of version {index.get('version')}, rebuild it")
+        loaded_indexes[path] = index
+    return loaded_indexes[path]
+
+# ------------------------------------------------------------------------------------------------
+# instructions
+
+def ClassifyOperand(operand: str):
+    # the kind of one NASM operand: a register and its class, a memory reference and its size, an
+    # immediate or a label
+    text = re.sub(r'\{[^}]*\}', '', operand).strip().lower()
+    bcst = "{1to" in operand.lower()
+    if "[" in text:
+        size = next((bits for name, bits in memory_sizes.items() if re.match(rf'^{name}\b', text)), None)
+        return {"kind": "mem", "size": size, "bcst": bcst}
+    for pattern, register_class in register_classes:
+        if pattern.match(text):
+            return {"kind": "reg", "class": register_class, "name": text.replace("(", "").replace(")", "")}
+    if re.match(r'^[-+]?(0x[0-9a-f]+|[0-9][0-9a-f]*h?)$', text.split()[-1] if text else ""):
+        return {"kind": "imm"}
+    return {"kind": "label"}
+
+def OperandMatches(sdmOperand: str, operand: dict):
+    for alternative in sdmOperand.split("/"):
+        match = re.match(r'^(rm|rel|reg|r|moffs|m|imm|vm)(\d*)', alternative)
+        kind = operand["kind"]
+        if kind == "reg" and alternative in (operand["name"], operand["class"]):
+            return True
+        if kind == "reg" and alternative == "st(i)" and operand["class"] == "st":
+            return True
+        if kind == "reg" and alternative == "sreg" and operand["class"] == "sreg":
+            return True
+        if match is None:
+            continue
+        prefix, bits = match.group(1), match.group(2)
+        if kind == "reg" and prefix in ("rm", "r", "reg") and (operand["class"] == f"r{bits}" or (not bits and operand["class"] in ("r32", "r64"))):
+            return True
+        if kind == "mem" and prefix in ("rm", "m", "moffs", "vm"):
+            if alternative.endswith("bcst"):
+                if operand["bcst"]:
+                    return True
+                continue
+            if operand["size"] is None or not bits or operand["size"] == int(bits) or prefix == "vm":
+                return True
+        if kind == "imm" and prefix == "imm":
+            return True
+        if kind in ("label", "imm") and prefix == "rel":
+            return True
+    return False
+
+def ParseNasmInstruction(line: str):
+    # "{evex} VADDPD  zmm0{k7}, zmm2, zword [rax]" -> ("evex", "VADDPD", [operands])
+    space = None
+    line = line.strip()
+    while line.startswith("{"):
+        end = line.find("}")
+        word = line[1:end].lower()
+        if word in ("vex", "vex2", "vex3", "evex"):
+            space = "evex" if word == "evex" else "vex"
+        line = line[end + 1:].strip()
+    words = line.split(None, 1)
+    if not words:
+        return space, None, []
+    rest = re.sub(r'^\{[^}]*\}\s*', '', words[1]) if len(words) > 1 else ""
+    operands = [operand.strip() for operand in rest.split(",") if operand.strip()]
+    # a rounding or SAE operand is a decoration of the instruction, not an operand of the form
+    operands = [operand for operand in operands if not re.match(r'^\{[^}]*\}$', operand)]
+    return space, words[0].upper(), operands
+
+def GetForms(index: dict, line: str):
+    # the forms of the SDM whose mnemonic, encoding space and operands fit an instruction line
+    space, mnemonic, operands = ParseNasmInstruction(line)
+    if mnemonic is None:
+        return []
+    classified = [ClassifyOperand(operand) for operand in operands]
+    return [form for form in index["forms"].get(mnemonic, [])
+            if (space is None or form["encoding"]["space"] == space) and len(form["operands"]) == len(classified)
+            and all(OperandMatches(sdm, operand) for sdm, operand in zip(form["operands"], classified))]
+
+# ------------------------------------------------------------------------------------------------
+# bytes
+
+def DecodeEncoding(data: bytes):
+    # the prefixes, VEX/EVEX fields and the bytes from the opcode on of one instruction
+    decoded = {"space": "legacy", "prefixes": [], "rex_w": False, "L": None, "pp": None, "map": None, "W": None, "b": False, "rest": b""}
+    i = 0
+    while i < len(data) and data[i] in LEGACY_PREFIXES:
+        decoded["prefixes"].append(data[i])
+        i += 1
+    if i >= len(data):
+        return decoded
+    first = data[i]
+    if first == 0xC5 and i + 1 < len(data):
+        decoded.update(space="vex", W=0, map=1, L=(data[i + 1] >> 2) & 1, pp=data[i + 1] & 3, rest=data[i + 2:])
+    elif first == 0xC4 and i + 2 < len(data):
+        decoded.update(space="vex", map=data[i + 1] & 0x1F, W=data[i + 2] >> 7, L=(data[i + 2] >> 2) & 1, pp=data[i + 2] & 3, rest=data[i + 3:])
+    elif first == 0x62 and i + 3 < len(data):
+        decoded.update(space="evex", map=data[i + 1] & 0x7, W=data[i + 2] >> 7, pp=data[i + 2] & 3,
+                       L=(data[i + 3] >> 5) & 3, b=bool(data[i + 3] & 0x10), rest=data[i + 4:])
+    elif first == 0xD5 and i + 1 < len(data):
+        # REX2, its M0 bit stands for the 0F escape
+        decoded.update(rex_w=bool(data[i + 1] & 0x08), rest=(b"\x0f" if data[i + 1] & 0x80 else b"") + data[i + 2:])
+    elif 0x40 <= first <= 0x4F:
+        decoded.update(rex_w=bool(first & 0x08), rest=data[i + 1:])
+    else:
+        decoded["rest"] = data[i:]
+    return decoded
+
+def MatchEncoding(encoding: dict, data: bytes):
+    # None if the bytes are an encoding of the form, otherwise what differs
+    decoded = DecodeEncoding(data)
+    if decoded["space"] != encoding["space"]:
+        return f"{decoded['space']} encoding instead of {encoding['space']}"
+    if encoding["space"] == "legacy":
+        missing = [prefix for prefix in encoding["prefixes"] if MANDATORY_PREFIXES[prefix] not in decoded["prefixes"]]
+        if missing:
+            return f"mandatory prefix {' '.join(missing)} missing"
+        if encoding["no_prefix"] and any(prefix in decoded["prefixes"] for prefix in MANDATORY_PREFIXES.values()):
+            return "66/F2/F3 prefix on an NP form"
+        if encoding["rex_w"] and not decoded["rex_w"]:
+            return "REX.W missing"
+    else:
+        for field in ("map", "pp", "W"):
+            if encoding[field] is not None and decoded[field] != encoding[field]:
+                return f"{encoding['space'].upper()}.{field} {decoded[field]} instead of {encoding[field]}"
+        rest = decoded["rest"]
+        # with EVEX.b on a register form L'L holds the rounding control
+        register_form = len(rest) > 1 and rest[1] >> 6 == 3
+        if encoding["L"] is not None and decoded["L"] != encoding["L"] and not (decoded["b"] and register_form):
+            return f"{encoding['space'].upper()}.L {decoded['L']} instead of {encoding['L']}"
+    rest = decoded["rest"]
+    opcode = encoding["opcode"]
+    if len(rest) < len(opcode):
+        return "instruction too short for the opcode"
+    actual = list(rest[:len(opcode)])
+    if encoding["plus_reg"]:
+        actual[-1] &= 0xF8
+    if actual != opcode:
+        return f"opcode {bytes(rest[:len(opcode)]).hex(' ')} instead of {bytes(opcode).hex(' ')}"
+    if encoding["modrm"] is not None:
+        if len(rest) <= len(opcode):
+            return "ModRM missing"
+        if encoding["modrm"] != "r" and (rest[len(opcode)] >> 3) & 7 != encoding["modrm"]:
+            return f"ModRM.reg {(rest[len(opcode)] >> 3) & 7} instead of /{encoding['modrm']}"
+    return None
+
+def CheckEncoding(index: dict, line: str, data: bytes):
+    # "pass" if the bytes fit one of the forms the SDM gives the instruction, "fail" if they fit
+    # none, "unknown" if the SDM has no form for it; with the expected forms and the mismatches
+    forms = GetForms(index, line)
+    if not forms:
+        return "unknown", [], []
+    mismatches = [MatchEncoding(form["encoding"], data) for form in forms]
+    if any(mismatch is None for mismatch in mismatches):
+        return "pass", [], []
+    return "fail", [form["source"] for form in forms], [f"{data.hex(' ')}: {mismatch}" for mismatch in mismatches]
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the SDM tables extracted by html_table_extractor.py into an index of expected encodings.')
+    parser.add_argument("csv", type=str, nargs="+", help="The CSV files of the tables, or directories of them")
+    parser.add_argument("--output", "-o", type=str, default=SDM_INDEX, help="The index to write")
+    args = parser.parse_args()
+
+    csv_files = []
+    for path in args.csv:
+        csv_files += sorted(glob.glob(os.path.join(path, "*.csv"))) if os.path.isdir(path) else [path]
+    index = BuildIndex(csv_files)
+    SaveIndex(args.output, index)
+    print(f"Indexed {sum(len(forms) for forms in index['forms'].values())} forms of {len(index['forms'])} mnemonics "
+          f"from {index['rows']} rows of {len(csv_files)} tables into {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+# snapshot of the output of a reference toolchain: one file holding the expected .text bytes,
+# symbols and parsed disassembly of every test, each entry compressed on its own and found
+# through an index at the end of the file
+#
+#   magic | entry | entry | ... | index | trailer (index offset, index length)
+
+import os
+import json
+import zlib
+import struct
+
+SNAPSHOT_MAGIC = b"TCSNAP01"
+SNAPSHOT_TRAILER = struct.Struct("<QQ")
+
+def WriteSnapshot(path: str, meta: dict, entries):
+    # entries yields (test, entry dict), the file is replaced atomically once complete
+    index = {}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        for test, entry in entries:
+            blob = zlib.compress(json.dumps(entry, separators=(",", ":")).encode())
+            index[test] = [f.tell(), len(blob)]
+            f.write(blob)
+        index_offset = f.tell()
+        blob = zlib.compress(json.dumps({"meta": meta, "index": index}, separators=(",", ":")).encode())
+        f.write(blob)
+        f.write(SNAPSHOT_TRAILER.pack(index_offset, len(blob)))
+    os.replace(tmp_path, path)
+    return len(index)
+
+class SnapshotReader:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        if self.file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a test case snapshot")
+        self.file.seek(-SNAPSHOT_TRAILER.size, os.SEEK_END)
+        index_offset, index_length = SNAPSHOT_TRAILER.unpack(self.file.read(SNAPSHOT_TRAILER.size))
+        self.file.seek(index_offset)
+        header = json.loads(zlib.decompress(self.file.read(index_length)))
+        self.meta = header["meta"]
+        self.index = header["index"]
+
+    def Tests(self):
+        return list(self.index)
+
+    def Get(self, test: str):
+        # the entry of one test, or None if the snapshot has no such test
+        if test not in self.index:
+            return None
+        offset, length = self.index[test]
+        self.file.seek(offset)
+        return json.loads(zlib.decompress(self.file.read(length)))
+
+    def Close(self):
+        self.file.close()
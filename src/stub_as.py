@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# stand-in assembler for benchmarking the pipeline without a nasm tree: accepts the command lines of
+# both toolchains, and writes an object with the same test_ labels as a real build, every instruction
+# encoded as one of a few fixed instructions picked by its test file, label and position, so the NASM
+# and GAS builds of a test produce the same bytes; -f bin writes the raw bytes and resolves the label
+# tables of the travis emitter
+
+import os
+import re
+import sys
+import zlib
+import struct
+import argparse
+
+from elf64 import ElfText, WriteElfText
+
+stub_encodings = [
+    "90",           # nop
+    "55",           # push %rbp
+    "5d",           # pop %rbp
+    "48 89 e5",     # mov %rsp,%rbp
+    "48 01 c0",     # add %rax,%rax
+    "01 c8",        # add %ecx,%eax
+    "0f 1f 00",     # nopl (%rax)
+    "66 90",        # xchg %ax,%ax
+    "c5 f1 58 cd",  # vaddpd %xmm5,%xmm1,%xmm1
+    "c3"            # ret
+]
+
+directive = re.compile(r'^(\.|(bits|section|global|default|extern)\b)', re.IGNORECASE)
+label = re.compile(r'^([A-Za-z_.$][\w.$]*):')
+label_table = re.compile(r'^dd\s+(.*)$', re.IGNORECASE)
+source_suffix = re.compile(r'_(nasm|gas)$')
+
+def GetStubBytes(name: str, index: int, differ: float):
+    h = zlib.crc32(f"{name}:{index}".encode())
+    if differ > 0 and zlib.crc32(name.encode()) % 10000 < differ * 10000:
+        h ^= 0x5a5a
+    return bytes.fromhex(stub_encodings[h % len(stub_encodings)])
+
+def AssembleStub(src: str, obj: str, differ: float = 0.0, format: str = "elf64"):
+    test = source_suffix.sub("", os.path.splitext(os.path.basename(src))[0])
+    data = bytearray()
+    symbols = {}
+    case, index = test, 0
+    with open(src, 'r') as f:
+        for line in f:
+            line = line.strip()
+            match = label.match(line)
+            if match:
+                symbols[match.group(1)] = len(data)
+                if match.group(1).startswith("test_"):
+                    case, index = f"{test}:{match.group(1)}", 0
+                line = line[match.end():].strip()
+            if not line or line.startswith(";") or line.startswith("#") or directive.match(line):
+                continue
+            match = label_table.match(line)
+            if match:
+                # labels defined before the table only
+                data += b"".join(struct.pack("<I", symbols[name.strip()]) for name in match.group(1).split(","))
+                continue
+            data += GetStubBytes(case, index, differ)
+            index += 1
+    if format == "bin":
+        with open(obj, 'wb') as f:
+            f.write(data)
+        return
+    WriteElfText(obj, ElfText(bytes(data), symbols))
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub assembler writing placeholder objects for benchmarks.')
+    parser.add_argument("-f", dest="format", type=str, default="elf64", choices=["elf64", "bin"], help="Output format")
+    parser.add_argument("-o", dest="output", type=str, required=True, help="The object to write")
+    parser.add_argument("--differ", type=float, default=0.0, help="Fraction of test cases encoded differently, to exercise the disassembly path of a check")
+    parser.add_argument("source", type=str, help="The source to assemble")
+    args = parser.parse_args()
+    AssembleStub(args.source, args.output, args.differ, args.format)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
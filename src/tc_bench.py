@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+# benchmark of the whole gen/build/check pipeline on a synthetic insns.xda with the stub assembler,
+# so it runs without a nasm tree and compares across commits
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+STUB_ASSEMBLER = os.path.join(SRC_DIR, "stub_as.py")
+RESULTS_FILE = "bench_results.json"
+
+# operands, encoding and flags of the synthetic records, cycled through the synthetic opcodes
+fixture_templates = [
+    ["reg32,reg32",                                "mr:\to32 01 /r",                                 "8086"],
+    ["mem,reg32",                                  "mr:\thle o32 01 /r",                             "386,SM,LOCK"],
+    ["rm64,imm8",                                  "mi:\to64 83 /0 ib,s",                            "X86_64,LONG"],
+    ["reg8,rm8",                                   "rm:\t02 /r",                                     "8086"],
+    ["void",                                       "\t90",                                           "8086"],
+    ["xmmreg,xmmreg*,xmmrm128",                    "rvm:\tvex.nds.128.66.0f 58 /r",                  "AVX,SANDYBRIDGE"],
+    ["ymmreg,ymmreg*,ymmrm256",                    "rvm:\tvex.nds.256.66.0f 58 /r",                  "AVX,SANDYBRIDGE"],
+    ["zmmreg|mask|z,zmmreg*,zmmrm512|b64|er",      "rvm:fv:\tevex.nds.512.66.0f.w1 58 /r",           "AVX512"],
+    ["kreg16,kreg16*,kreg16",                      "rvm:\tvex.nds.l1.0f.w0 4a /r",                   "AVX512DQ"],
+    ["reg64,rm64",                                 "rm:\tevex.nf0.l0.m4.o64 03 /r",                  "APX"]
+]
+
+pipeline_stages = ["parse", "emit", "build_nasm_ref", "build_nasm_cur", "build_gas", "check_nasm", "check_gas"]
+
+# parse and expand the xda file in memory only, for the cost of tc_gen.py without the file writes
+PARSE_SCRIPT = """
+import sys, json
+sys.path.insert(0, sys.argv[1])
+from tc_gen import LoadXdaDatabase, GetOpcodeList, RemoveBlacklistedOpcodes, IterInstructionPairs
+xdaDb = LoadXdaDatabase(sys.argv[2])
+opcodes = RemoveBlacklistedOpcodes(GetOpcodeList(xdaDb))
+print(json.dumps({"opcodes": len(opcodes), "instructions": sum(1 for opcode in opcodes for _ in IterInstructionPairs(opcode, xdaDb))}))
+"""
+
+def WriteFixture(path: str, opcodes: int):
+    # one synthetic opcode per record, the same file for the same count on every commit
+    with open(path, 'w') as f:
+        f.write("; synthetic benchmark fixture\n")
+        for i in range(opcodes):
+            operands, encoding, flags = fixture_templates[i % len(fixture_templates)]
+            f.write(f"BENCH{i:05d}\t\t{operands}\t\t[{encoding}]\t\t{flags}\n")
+
+def CountFiles(directory: str, suffix: str):
+    return sum(1 for name in os.listdir(directory) if name.endswith(suffix)) if os.path.isdir(directory) else 0
+
+def RunStage(name: str, command: list, workDir: str):
+    # run one stage as its own process tree, the peak RSS is the largest of the processes it waited for
+    log = os.path.join(workDir, f"{name}.log")
+    start = time.perf_counter()
+    with open(log, 'w') as f:
+        proc = subprocess.Popen(command, cwd=workDir, stdout=f, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return {"stage": name, "seconds": seconds, "returncode": proc.returncode, "peak_rss_kib": usage.ru_maxrss,
+            "user_seconds": usage.ru_utime, "system_seconds": usage.ru_stime}
+
+def RunPipeline(workDir: str, fixture: str, batch: int, group: str, jobs: int, differ: float):
+    python = sys.executable
+    stub = f"{shlex.quote(python)} {shlex.quote(STUB_ASSEMBLER)}"
+    src_dir = os.path.join(workDir, "target_src")
+    out_dir = os.path.join(workDir, "output")
+    for path in (src_dir, out_dir):
+        shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(os.path.join(src_dir, "nasm"))
+    os.makedirs(os.path.join(src_dir, "gas"))
+
+    commands = {
+        "parse":          [python, "-c", PARSE_SCRIPT, SRC_DIR, fixture],
+        "emit":           [python, os.path.join(SRC_DIR, "tc_gen.py"), "-i", fixture, "--batch", str(batch), "--group", group, "--jobs", str(jobs)],
+        "build_nasm_ref": [python, os.path.join(SRC_DIR, "tc_build.py"), "-t", "nasm", "-a", stub, "-o", os.path.join(out_dir, "nasm.ref"), "-j", str(jobs), "--force"],
+        "build_nasm_cur": [python, os.path.join(SRC_DIR, "tc_build.py"), "-t", "nasm", "-a", f"{stub} --differ {differ}", "-o", os.path.join(out_dir, "nasm.cur"), "-j", str(jobs), "--force"],
+        "build_gas":      [python, os.path.join(SRC_DIR, "tc_build.py"), "-t", "gas", "-a", stub, "-o", os.path.join(out_dir, "gas"), "-j", str(jobs), "--force"],
+        "check_nasm":     [python, os.path.join(SRC_DIR, "tc_check.py"), "nasm", "-o", out_dir, "-s", src_dir, "-j", str(jobs), "-r", os.path.join(workDir, "check_nasm.json")],
+        "check_gas":      [python, os.path.join(SRC_DIR, "tc_check.py"), "gas", "-o", out_dir, "-s", src_dir, "-j", str(jobs), "-r", os.path.join(workDir, "check_gas.json")]
+    }
+    stages = []
+    instructions = 0
+    for name in pipeline_stages:
+        stats = os.path.join(workDir, f"{name}.stats.json")
+        stage = RunStage(name, commands[name] + (["--stats", stats] if name != "parse" else []), workDir)
+        if os.path.exists(stats):
+            with open(stats, 'r') as f:
+                stage["counters"] = json.load(f)["counters"]
+            os.remove(stats)
+        if name == "parse":
+            with open(os.path.join(workDir, "parse.log"), 'r') as f:
+                counts = json.loads(f.read().splitlines()[-1])
+            instructions = counts["instructions"]
+            stage.update(files=0, instructions=instructions, opcodes=counts["opcodes"])
+        elif name == "emit":
+            stage.update(files=CountFiles(os.path.join(src_dir, "nasm"), "_nasm.asm") + CountFiles(os.path.join(src_dir, "gas"), "_gas.s"),
+                         instructions=2 * instructions)
+        elif name.startswith("build_"):
+            stage.update(files=CountFiles(os.path.join(out_dir, name[len("build_"):].replace("_", ".")), ".o"), instructions=instructions)
+        else:
+            with open(os.path.join(workDir, f"{name}.json"), 'r') as f:
+                results = json.load(f)
+            stage.update(files=len({result["file"] for result in results}), instructions=len(results),
+                         failed=sum(1 for result in results if result["status"] == "fail"))
+        stage["files_per_second"] = stage["files"] / stage["seconds"] if stage["seconds"] > 0 else 0.0
+        stage["instructions_per_second"] = stage["instructions"] / stage["seconds"] if stage["seconds"] > 0 else 0.0
+        stages.append(stage)
+    return stages
+
+def GetCommit():
+    try:
+        proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        return proc.stdout.strip() or None
+    except OSError:
+        return None
+
+def PrintStages(stages: list, baseline: dict = None):
+    print(f"{'stage':<16}{'seconds':>10}{'files/s':>12}{'insns/s':>12}{'peak RSS':>12}")
+    for stage in stages:
+        line = (f"{stage['stage']:<16}{stage['seconds']:>10.3f}{stage['files_per_second']:>12.1f}"
+                f"{stage['instructions_per_second']:>12.1f}{stage['peak_rss_kib'] / 1024:>10.1f}MB")
+        previous = baseline.get(stage["stage"]) if baseline else None
+        if previous and previous["seconds"] > 0:
+            line += f"  {(stage['seconds'] / previous['seconds'] - 1) * 100:+.1f}%"
+        if stage["returncode"] != 0:
+            line += f"  (exit {stage['returncode']}, see {stage['stage']}.log)"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the gen/build/check pipeline on a synthetic xda file with stub assemblers.')
+    parser.add_argument("--opcodes", "-n", type=int, default=200, help="Number of synthetic opcodes in the fixture")
+    parser.add_argument("--batch", "-b", type=int, default=1, help="Instructions per test file, passed to tc_gen.py")
+    parser.add_argument("--group", "-g", type=str, choices=["opcode", "family"], default="opcode", help="Grouping of the test files, passed to tc_gen.py")
+    parser.add_argument("--jobs", "-j", type=int, default=0, help="Number of processes of every stage, 0 uses all CPUs")
+    parser.add_argument("--differ", type=float, default=0.01, help="Fraction of test cases nasm.cur encodes differently, so the check disassembles them")
+    parser.add_argument("--repeat", "-r", type=int, default=1, help="Run the pipeline this many times and keep the fastest run of every stage")
+    parser.add_argument("--work-dir", "-w", type=str, help="Directory to run in, a temporary one removed afterwards by default")
+    parser.add_argument("--output", "-o", type=str, default=RESULTS_FILE, help="Write the results to this JSON file")
+    parser.add_argument("--compare", "-c", type=str, help="Results of an earlier run to show the change in wall time against")
+    args = parser.parse_args()
+
+    # the stages run inside the work directory, so every path handed to them is absolute
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="tc_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    fixture = os.path.join(work_dir, "insns.xda")
+    WriteFixture(fixture, args.opcodes)
+    print(f"Benchmarking {args.opcodes} synthetic opcodes in {work_dir} ...")
+
+    best = {}
+    try:
+        for _ in range(args.repeat):
+            for stage in RunPipeline(work_dir, fixture, args.batch, args.group, args.jobs, args.differ):
+                if stage["stage"] not in best or stage["seconds"] < best[stage["stage"]]["seconds"]:
+                    best[stage["stage"]] = stage
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    stages = [best[name] for name in pipeline_stages]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = {stage["stage"]: stage for stage in json.load(f)["stages"]}
+    PrintStages(stages, baseline)
+
+    report = {"commit": GetCommit(), "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "python": platform.python_version(), "cpus": os.cpu_count(),
+              "parameters": {"opcodes": args.opcodes, "batch": args.batch, "group": args.group,
+                             "jobs": args.jobs, "differ": args.differ, "repeat": args.repeat},
+              "total_seconds": sum(stage["seconds"] for stage in stages), "stages": stages}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Wrote the results to {args.output}")
+    return 0 if all(stage["returncode"] == 0 for stage in stages) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from instrument import Count, Timer, WriteStats
+
+# source suffix, object suffix and command line of every supported toolchain
+toolchains = {
+    "nasm" : ["_nasm.asm", "_nasm.o", "{assembler} -f elf64 {src} -o {obj}"],
+    "gas"  : ["_gas.s",    "_gas.o",  "{assembler} {src} -o {obj}"]
+}
+
+default_assemblers = {
+    "nasm" : "nasm",
+    "gas"  : "as"
+}
+
+RESULTS_FILE = "build_results.json"
+# the assembler the objects of an output directory were built by
+STAMP_FILE = "assembler_stamp.json"
+
+# every case of a batched source starts at the directive exporting its label
+case_start = re.compile(r'^\s*(?:global|\.globl)\s+(test_\S+)')
+# nasm reports "file:line: error: ...", gas "file:line: Error: ..."
+error_line = re.compile(r':(\d+):\s*(?:fatal:\s*)?(?:error|Error)')
+
+def GetSourceList(srcDir: str, toolchain: str):
+    suffix = toolchains[toolchain][0]
+    return sorted(name for name in os.listdir(srcDir) if name.endswith(suffix))
+
+def GetObjectName(source: str, toolchain: str):
+    src_suffix, obj_suffix, _ = toolchains[toolchain]
+    return source[:-len(src_suffix)] + obj_suffix
+
+def IsUpToDate(src: str, obj: str):
+    return os.path.exists(obj) and os.path.getmtime(obj) >= os.path.getmtime(src)
+
+def GetAssemblerStamp(assembler: str):
+    # the command line and the binary it runs: a rebuilt assembler leaves the sources unchanged, so
+    # the objects it did not build are only known to be stale by the binary's mtime and size
+    command = shlex.split(assembler)
+    path = os.path.abspath(shutil.which(command[0]) or command[0])
+    stamp = {"command": command, "path": path}
+    if os.path.exists(path):
+        st = os.stat(path)
+        stamp.update(mtime=st.st_mtime_ns, size=st.st_size)
+    return stamp
+
+def LoadAssemblerStamp(outDir: str):
+    try:
+        with open(os.path.join(outDir, STAMP_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def AssembleFile(command: list, src: str, obj: str):
+    # run one assembler process and keep its stderr, a failure never stops the build
+    start = time.perf_counter()
+    Count("assembler_calls")
+    with Timer("assemble", source=src):
+        try:
+            proc = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            returncode, stderr = proc.returncode, proc.stderr
+        except OSError as e:
+            returncode, stderr = 127, f"{command[0]}: {e.strerror}\n"
+    if returncode != 0:
+        Count("assembler_failures")
+        if os.path.exists(obj):
+            os.remove(obj)
+    return {"source": src, "object": obj, "status": "ok" if returncode == 0 else "failed",
+            "returncode": returncode, "stderr": stderr, "seconds": time.perf_counter() - start}
+
+def GetCommand(toolchain: str, assembler: str, src: str, obj: str):
+    return shlex.split(toolchains[toolchain][2].format(assembler=assembler, src=shlex.quote(src), obj=shlex.quote(obj)))
+
+def SplitCases(lines: list):
+    # split a batched source into its header, the lines of every case and the footer
+    starts = [i for i, line in enumerate(lines) if case_start.match(line)]
+    if not starts:
+        return None
+    end = next((i for i in range(len(lines) - 1, starts[-1], -1) if lines[i].strip() == "ret"), len(lines))
+    bounds = starts + [end]
+    return lines[:starts[0]], [lines[bounds[k]:bounds[k + 1]] for k in range(len(starts))], lines[end:]
+
+def AssembleCases(command: list, src: str, obj: str, header: list, cases: list, footer: list):
+    with open(src, 'w') as f:
+        f.writelines(header + [line for case in cases for line in case] + footer)
+    return AssembleFile(command, src, obj)
+
+def GetFailingCases(stderr: str, header: list, cases: list):
+    # map the line numbers of the assembler errors to the cases they fall in
+    lines = {int(match.group(1)) for match in error_line.finditer(stderr)}
+    failing = []
+    first = len(header) + 1
+    for k, case in enumerate(cases):
+        if any(first <= line < first + len(case) for line in lines):
+            failing.append(k)
+        first += len(case)
+    return failing
+
+def BisectCases(command: list, src: str, obj: str, header: list, cases: list, footer: list):
+    # the cases which do not assemble, found by halving when the errors name no line
+    if AssembleCases(command, src, obj, header, cases, footer)["status"] == "ok":
+        return []
+    if len(cases) == 1:
+        return cases
+    half = len(cases) // 2
+    return (BisectCases(command, src, obj, header, cases[:half], footer) +
+            BisectCases(command, src, obj, header, cases[half:], footer))
+
+def IsolateFailures(toolchain: str, assembler: str, result: dict):
+    # a batched source holds many cases, one rejected instruction must not lose all of them: drop the
+    # cases the errors point at, bisect if they point nowhere, and assemble the object from the rest
+    src, obj = result["source"], result["object"]
+    with open(src, 'r') as f:
+        split = SplitCases(f.readlines())
+    if split is None or len(split[1]) < 2:
+        return result
+    header, cases, footer = split
+    tmp_src = obj + ".isolate" + toolchains[toolchain][0]
+    tmp_command = GetCommand(toolchain, assembler, tmp_src, obj)
+    excluded = []
+    stderr = result["stderr"]
+    try:
+        while cases:
+            failing = GetFailingCases(stderr, header, cases)
+            if failing:
+                excluded += [cases[k] for k in failing]
+                cases = [case for k, case in enumerate(cases) if k not in failing]
+            else:
+                bad = BisectCases(tmp_command, tmp_src, obj, header, cases, footer)
+                if not bad:
+                    break
+                excluded += bad
+                cases = [case for case in cases if case not in bad]
+            if not cases:
+                break
+            attempt = AssembleCases(tmp_command, tmp_src, obj, header, cases, footer)
+            if attempt["status"] == "ok":
+                break
+            stderr = attempt["stderr"]
+    finally:
+        if os.path.exists(tmp_src):
+            os.remove(tmp_src)
+    if not cases or not os.path.exists(obj):
+        return result
+    result = dict(result, status="partial")
+    result["excluded"] = [case_start.match(case[0]).group(1) for case in excluded]
+    Count("cases_excluded", len(excluded))
+    return result
+
+def BuildFile(toolchain: str, assembler: str, src: str, obj: str, isolate: bool):
+    result = AssembleFile(GetCommand(toolchain, assembler, src, obj), src, obj)
+    if result["status"] == "failed" and isolate:
+        start = time.perf_counter()
+        with Timer("isolate", source=src):
+            result = IsolateFailures(toolchain, assembler, result)
+        result["seconds"] += time.perf_counter() - start
+    return result
+
+def BuildAll(toolchain: str, assembler: str, srcDir: str, outDir: str, jobs: int = 0, force: bool = False, isolate: bool = True):
+    # assemble every source of the toolchain into outDir with a bounded pool of assembler processes
+    os.makedirs(outDir, exist_ok=True)
+    stamp = GetAssemblerStamp(assembler)
+    if not force and LoadAssemblerStamp(outDir) != stamp:
+        print(f"{stamp['path']} differs from the assembler of {outDir}, assembling every source")
+        force = True
+    results = []
+    tasks = []
+    for source in GetSourceList(srcDir, toolchain):
+        src = os.path.join(srcDir, source)
+        obj = os.path.join(outDir, GetObjectName(source, toolchain))
+        if not force and IsUpToDate(src, obj):
+            results.append({"source": src, "object": obj, "status": "up-to-date", "returncode": 0, "stderr": "", "seconds": 0.0})
+            Count("files_up_to_date")
+            continue
+        tasks.append((toolchain, assembler, src, obj, isolate))
+
+    with ThreadPoolExecutor(max_workers=jobs if jobs > 0 else os.cpu_count()) as pool:
+        for result in pool.map(lambda task: BuildFile(*task), tasks):
+            if result["status"] == "failed":
+                print(f"Failed to assemble {result['source']}:\n{result['stderr']}", end="" if result["stderr"].endswith("\n") else "\n")
+            elif result["status"] == "partial":
+                print(f"Assembled {result['source']} without {len(result['excluded'])} rejected cases: {' '.join(result['excluded'])}")
+            results.append(result)
+    # written last, so an interrupted build is redone in full
+    with open(os.path.join(outDir, STAMP_FILE), 'w') as f:
+        json.dump(stamp, f, indent=1)
+    return results
+
+def PrintSummary(toolchain: str, results: list, seconds: float):
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    assembled = counts.get("ok", 0) + counts.get("partial", 0) + counts.get("failed", 0)
+    rate = assembled / seconds if seconds > 0 else 0.0
+    print(f"{toolchain}: {assembled} files assembled ({counts.get('failed', 0)} failed, {counts.get('partial', 0)} partial), "
+          f"{counts.get('up-to-date', 0)} up to date in {seconds:.2f}s, {rate:.1f} files/s")
+
+def main():
+    parser = argparse.ArgumentParser(description='Assemble the generated test files with a pool of assembler processes.')
+    parser.add_argument("--toolchain", "-t", type=str, choices=list(toolchains), required=True, help="The toolchain the sources are written for")
+    parser.add_argument("--assembler", "-a", type=str, help="The assembler command, nasm or as by default")
+    parser.add_argument("--src-dir", "-s", type=str, help="Directory of the generated sources, target_src/<toolchain> by default")
+    parser.add_argument("--output-dir", "-o", type=str, required=True, help="Directory to write the objects to")
+    parser.add_argument("--jobs", "-j", type=int, default=0, help="Number of assembler processes running at once, 0 uses all CPUs")
+    parser.add_argument("--force", "-f", action="store_true", help="Assemble every source even if its object is up to date")
+    parser.add_argument("--stats", type=str, help="Write the counters and timers of the build to this JSON file")
+    parser.add_argument("--trace", type=str, help="Write a Chrome trace of the build to this file")
+    parser.add_argument("--no-isolate", dest="isolate", action="store_false", help="Fail a whole batched source instead of dropping the cases the assembler rejects")
+    args = parser.parse_args()
+
+    assembler = args.assembler or default_assemblers[args.toolchain]
+    src_dir = args.src_dir or os.path.join("target_src", args.toolchain)
+
+    print(f"Compiling {src_dir} by {assembler} into {args.output_dir} ...")
+    start = time.perf_counter()
+    results = BuildAll(args.toolchain, assembler, src_dir, args.output_dir, args.jobs, args.force, args.isolate)
+    PrintSummary(args.toolchain, results, time.perf_counter() - start)
+
+    with open(os.path.join(args.output_dir, RESULTS_FILE), 'w') as f:
+        json.dump(results, f, indent=1)
+    WriteStats(f"build_{args.toolchain}", args.stats, args.trace)
+
+    # like the '-' prefix of the old make rules, failures of single files do not fail the build
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
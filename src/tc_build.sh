@@ -26,50 +26,27 @@ output_cur=${cur_dir}/output/nasm.cur
 
 output_gas=${cur_dir}/output/gas
 
-# build nasm source with ref and the cur
+tc_build="python3 $(dirname $0)/tc_build.py --force"
 
-# prepare the instruction list
-pushd $src_nasm
-nasm_insns=$(ls | sed 's/^test_//' | sed 's/_nasm\.asm//' | sort -u -V)
-popd
+# build nasm source with ref and the cur
 
 if [ "$build_nasm" -eq "1" ]; then
 	# build with ref
 	rm -rf $output_ref
-	mkdir -p $output_ref
-
 	echo "Compiling by nasm ref ..." | tee /dev/stderr
-	for nasm_insn in $nasm_insns
-	do
-		${nasm_ref} -f elf64 -o ${output_ref}/test_${nasm_insn}_nasm.asm.o $src_nasm/test_${nasm_insn}_nasm.asm
-	done
+	${tc_build} --toolchain nasm --assembler ${nasm_ref} --src-dir $src_nasm --output-dir $output_ref --stats stats_build_nasm_ref.json
 fi
 
 # always build current nasm
 rm -rf $output_cur
-mkdir -p $output_cur
-
 echo "Compiling by nasm cur ..." | tee /dev/stderr
-for nasm_insn in $nasm_insns
-do
-	${nasm_cur} -f elf64 -o ${output_cur}/test_${nasm_insn}_nasm.asm.o $src_nasm/test_${nasm_insn}_nasm.asm
-done
+${tc_build} --toolchain nasm --assembler ${nasm_cur} --src-dir $src_nasm --output-dir $output_cur --stats stats_build_nasm_cur.json
 
 # build gas source
 
-# prepare the instruction list
-pushd $src_gas
-gas_insns=$(ls | sed 's/^test_//' | sed 's/_gas\.s//' | sort -u -V)
-popd
-
 if [ "$build_gas" -eq "1" ]; then
 	# build with gas
 	rm -rf $output_gas
-	mkdir -p $output_gas
-
 	echo "Compiling by gas ..." >&2
-	for gas_insn in $gas_insns
-	do
-		${gas} -o ${output_gas}/test_${gas_insn}_gas.s.o $src_gas/test_${gas_insn}_gas.s
-	done
+	${tc_build} --toolchain gas --assembler ${gas} --src-dir $src_gas --output-dir $output_gas --stats stats_build_gas.json
 fi
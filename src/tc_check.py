@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import hashlib
+import time
+import difflib
+import argparse
+import subprocess
+import multiprocessing
+from typing import NamedTuple
+
+from elf64 import ReadElfText, SliceBySymbols, ElfText
+from normalize import CompileRules, Normalize
+from snapshot import SnapshotReader
+from disasm_cache import GetCacheKey, LoadCachedDisassembly, StoreCachedDisassembly, EvictCache, DEFAULT_CACHE_SIZE
+from baseline import GetSignature, LoadBaseline, SaveBaseline, CompareFailures
+from results_db import OpenDatabase, LoadFamilyIndex, RecordRun, GetOpcode
+from instrument import Count, Timer, TakeStats, ResetStats, MergeStats, WriteStats, GetSummary
+from sdm_oracle import SDM_INDEX, LoadIndex, CheckEncoding
+
+# reference output, its object suffix, the objdump flags and the reference source of every
+# check mode, the tested output is always the objects built by the current nasm; the sdm mode
+# checks against the index of the SDM encodings instead of reference objects
+check_modes = {
+    "nasm" : ["nasm.ref", "_nasm.o", ["-d"],                                     "nasm", "_nasm.asm"],
+    "gas"  : ["gas",      "_gas.o",  ["-d", "--no-show-raw-insn", "--no-addresses"], "gas",  "_gas.s"],
+    "sdm"  : [None,       None,      [],                                         "nasm", "_nasm.asm"]
+}
+
+CUR_DIR = "nasm.cur"
+CUR_SUFFIX = "_nasm.o"
+# the ret tc_gen.py writes after the last case of a batched file
+BATCH_FOOTER = b"\xc3"
+# push rbp; mov rbp,rsp ahead of the instruction of a single test
+PROLOGUE = bytes.fromhex("55 48 89 e5")
+
+class CheckOptions(NamedTuple):
+    mode: str
+    outputDir: str
+    srcDir: str
+    cacheDir: str = None
+    snapshot: str = None    # reference snapshot used instead of the reference objects
+    sdmIndex: str = None    # index of the SDM encodings of the sdm mode
+
+class Insn(NamedTuple):
+    address: str
+    bytes: str
+    text: str
+
+    def __str__(self):
+        return "\t".join(field for field in self if field)
+
+def IsBatched(test: str):
+    return re.search(r'_b[0-9]+$', test) is not None
+
+def GetTestList(srcDir: str):
+    # test_<name>_nasm.asm -> <name>
+    tests = [name[len("test_"):-len("_nasm.asm")] for name in os.listdir(srcDir)
+             if name.startswith("test_") and name.endswith("_nasm.asm")]
+    return sorted(tests, key=lambda test: [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', test)])
+
+def GetObjdumpFlags(mode: str, test: str):
+    flags = check_modes[mode][2]
+    # addresses of a batched file shift with every length change, so only compare them per file
+    if IsBatched(test) and "--no-addresses" not in flags:
+        flags = flags + ["--no-addresses"]
+    return flags
+
+def Objdump(obj: str, flags: list):
+    Count("objdump_calls")
+    with Timer("objdump", object=obj):
+        proc = subprocess.run(["objdump"] + flags + [obj], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"objdump failed on {obj}: {proc.stderr.strip()}")
+    return proc.stdout
+
+def ParseDisassembly(dump: str, test: str, raw: bool = True):
+    # split the objdump output into the instructions of every test case; a batched file has one
+    # test_<opcode>_<i> label per case, a single test file is one case whatever its labels are
+    cases = {}
+    label = None if IsBatched(test) else f"test_{test}"
+    for line in dump.splitlines():
+        if line.endswith(">:"):
+            name = line[line.index("<") + 1:-2]
+            if IsBatched(test) and name.startswith("test_"):
+                label = name
+            continue
+        if not line.startswith((" ", "\t")) or label is None:
+            continue
+        # [address:] [raw bytes] [text], a long encoding wraps into a line of raw bytes only
+        fields = line.split("\t")
+        address = fields[0].strip().rstrip(":")
+        if raw:
+            insn = Insn(address, fields[1].strip(), " ".join(field.strip() for field in fields[2:]))
+        else:
+            insn = Insn(address, "", " ".join(field.strip() for field in fields[1:]))
+        cases.setdefault(label, []).append(insn)
+    return cases
+
+compiled_rules = {}
+
+def ApplyNormalization(mode: str, ref: list, cur: list):
+    # rewrite the known-benign differences, the rules are compiled once per process
+    if mode not in compiled_rules:
+        compiled_rules[mode] = (CompileRules(mode, "ref"), CompileRules(mode, "cur"))
+    ref_rules, cur_rules = compiled_rules[mode]
+    ref, ref_fired = Normalize(ref_rules, ref)
+    cur, cur_fired = Normalize(cur_rules, cur)
+    fired = ref_fired + [name for name in cur_fired if name not in ref_fired]
+    for name in fired:
+        Count(f"normalization:{name}")
+    return ref, cur, fired
+
+def ReadSourceLines(path: str, test: str):
+    # map every test case label to its instruction line in the source file
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        lines = [line.strip() for line in f]
+    if IsBatched(test):
+        return {line[:-1]: lines[i + 1] for i, line in enumerate(lines[:-1]) if line.startswith("test_") and line.endswith(":")}
+    if "near1:" not in lines:
+        return {}
+    before = [line for line in lines[:lines.index("near1:")] if line]
+    return {f"test_{test}": before[-1] if before else ""}
+
+def GetCaseBytes(text, test: str):
+    # the .text bytes of every test case of an object, read straight from the ELF file; the ret
+    # closing a batched file is not part of its last case, which differs between the objects when
+    # the reference assembler rejected the cases after it
+    if IsBatched(test):
+        cases = SliceBySymbols(text, "test_")
+        if cases:
+            last = list(cases)[-1]
+            if cases[last].endswith(BATCH_FOOTER):
+                cases[last] = cases[last][:-len(BATCH_FOOTER)]
+        return cases
+    return {f"test_{test}": text.data}
+
+def StripBatchFooter(cases: dict):
+    # the parsed instructions of a batched file without the closing ret
+    if not cases:
+        return cases
+    last = list(cases)[-1]
+    insns = cases[last]
+    if insns and insns[-1].text.split()[:1] in (["ret"], ["retq"]):
+        return dict(cases, **{last: insns[:-1]})
+    return cases
+
+def DisassembleCases(obj: str, text, mode: str, test: str, cacheDir: str = None):
+    # parsed objdump output of an object per test case, and whether it came from the cache
+    flags = GetObjdumpFlags(mode, test)
+    if cacheDir:
+        key = GetCacheKey(text, flags, None if IsBatched(test) else f"test_{test}")
+        cached = LoadCachedDisassembly(cacheDir, key)
+        if cached is not None:
+            Count("disasm_cache_hits")
+            return {label: [Insn(*insn) for insn in insns] for label, insns in cached.items()}, True
+        Count("disasm_cache_misses")
+    cases = ParseDisassembly(Objdump(obj, flags), test, "--no-show-raw-insn" not in flags)
+    if cacheDir:
+        StoreCachedDisassembly(cacheDir, key, cases)
+    return cases, False
+
+def GetSourceHash(path: str):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+snapshot_readers = {}
+
+def LoadSnapshotReference(options: CheckOptions, test: str):
+    # the reference .text and parsed disassembly of a test from the snapshot; None when the
+    # reference toolchain failed on it and "stale" when the source changed since the snapshot
+    if options.snapshot not in snapshot_readers:
+        snapshot_readers[options.snapshot] = SnapshotReader(options.snapshot)
+    entry = snapshot_readers[options.snapshot].Get(test)
+    if entry is None or entry["status"] != "ok":
+        return None
+    _, _, _, src_dir, src_suffix = check_modes[options.mode]
+    src = os.path.join(options.srcDir, src_dir, f"test_{test}{src_suffix}")
+    if not os.path.exists(src) or entry["source"] != GetSourceHash(src) or entry["flags"] != GetObjdumpFlags(options.mode, test):
+        return "stale"
+    cases = {label: [Insn(*insn) for insn in insns] for label, insns in entry["cases"].items()}
+    return ElfText(bytes.fromhex(entry["data"]), entry["symbols"]), cases
+
+def GetInstructionBytes(text, label: str, data: bytes):
+    # the bytes of the instruction alone: a single test pushes rbp and sets up the frame before it,
+    # every case ends at its near1 label
+    start = text.symbols.get(label, 0)
+    end = text.symbols.get(f"near1_{label[len('test_'):]}", text.symbols.get("near1"))
+    if end is not None and start <= end <= start + len(data):
+        data = data[:end - start]
+    if data.startswith(PROLOGUE):
+        data = data[len(PROLOGUE):]
+    return data
+
+def CheckOracle(options: CheckOptions, test: str):
+    # check the bytes of every case of one nasm.cur object against the forms the SDM gives its
+    # instruction, in process; the instructions the SDM index does not know are only counted
+    cur_obj = os.path.join(options.outputDir, CUR_DIR, f"test_{test}{CUR_SUFFIX}")
+    if not os.path.exists(cur_obj):
+        return []
+    index = LoadIndex(options.sdmIndex)
+    sources = ReadSourceLines(os.path.join(options.srcDir, "nasm", f"test_{test}_nasm.asm"), test)
+    cur_text = ReadElfText(cur_obj)
+    results = []
+    for label, data in GetCaseBytes(cur_text, test).items():
+        data = GetInstructionBytes(cur_text, label, data)
+        status, expected, actual = CheckEncoding(index, sources.get(label, ""), data)
+        if status == "unknown":
+            Count("sdm_unknown")
+            continue
+        Count("cases_checked")
+        results.append({"test": label[len("test_"):], "file": test, "mode": options.mode, "status": status, "method": "sdm",
+                        "source": {"nasm": sources.get(label, "")}, "bytes": {"cur": data.hex(" ")},
+                        "expected": expected, "actual": actual, "rules": [], "cache_hits": 0, "cache_misses": 0})
+    return results
+
+def CheckTest(task):
+    # compare both objects of one test file in memory, case by case
+    options, test = task
+    if options.mode == "sdm":
+        return CheckOracle(options, test)
+    mode, cacheDir = options.mode, options.cacheDir
+    ref_dir, ref_suffix, _, _, _ = check_modes[mode]
+    ref_obj = os.path.join(options.outputDir, ref_dir, f"test_{test}{ref_suffix}")
+    cur_obj = os.path.join(options.outputDir, CUR_DIR, f"test_{test}{CUR_SUFFIX}")
+    if not os.path.exists(cur_obj) or (not options.snapshot and not os.path.exists(ref_obj)):
+        return []
+    reference = None
+    if options.snapshot:
+        reference = LoadSnapshotReference(options, test)
+        if reference is None:
+            return []
+        if reference == "stale":
+            return [{"test": test, "file": test, "mode": mode, "status": "stale", "method": "snapshot",
+                     "source": {}, "bytes": {}, "expected": [], "actual": [], "rules": [], "cache_hits": 0, "cache_misses": 0}]
+
+    sources = {"nasm": ReadSourceLines(os.path.join(options.srcDir, "nasm", f"test_{test}_nasm.asm"), test)}
+    if mode == "gas":
+        sources["gas"] = ReadSourceLines(os.path.join(options.srcDir, "gas", f"test_{test}_gas.s"), test)
+
+    # fast path: compare the raw .text bytes per case and only disassemble the cases which differ
+    ref_text = reference[0] if reference else ReadElfText(ref_obj)
+    cur_text = ReadElfText(cur_obj)
+    ref_bytes = GetCaseBytes(ref_text, test)
+    cur_bytes = GetCaseBytes(cur_text, test)
+    # like a test file without a reference object, a case the reference assembler rejected is not
+    # checked; a case only nasm.cur lost is a failure
+    labels = list(ref_bytes)
+    Count("cases_without_reference", len([label for label in cur_bytes if label not in ref_bytes]))
+    differ = [label for label in labels if ref_bytes.get(label) != cur_bytes.get(label)]
+    Count("cases_checked", len(labels))
+    Count("cases_bytes_equal", len(labels) - len(differ))
+    ref_cases, cur_cases = {}, {}
+    cache = []
+    if differ:
+        if reference:
+            ref_cases = reference[1]
+        else:
+            ref_cases, ref_hit = DisassembleCases(ref_obj, ref_text, mode, test, cacheDir)
+            cache.append(ref_hit)
+        cur_cases, cur_hit = DisassembleCases(cur_obj, cur_text, mode, test, cacheDir)
+        cache.append(cur_hit)
+        if IsBatched(test):
+            ref_cases, cur_cases = StripBatchFooter(ref_cases), StripBatchFooter(cur_cases)
+
+    results = []
+    for label in labels:
+        result = {"test": label[len("test_"):], "file": test, "mode": mode, "status": "pass", "method": "bytes",
+                  "source": {name: lines.get(label, "") for name, lines in sources.items()},
+                  "bytes": {"ref": ref_bytes.get(label, b"").hex(" "), "cur": cur_bytes.get(label, b"").hex(" ")},
+                  "expected": [], "actual": [], "rules": [], "cache_hits": 0, "cache_misses": 0}
+        if label in differ:
+            ref, cur, fired = ApplyNormalization(mode, ref_cases.get(label, []), cur_cases.get(label, []))
+            result.update(status="pass" if ref == cur else "fail", method="objdump", rules=fired,
+                          expected=[str(insn) for insn in ref], actual=[str(insn) for insn in cur])
+        results.append(result)
+    # count the objdump runs of the file once, on its first result
+    if results and cacheDir and cache:
+        results[0].update(cache_hits=cache.count(True), cache_misses=cache.count(False))
+    return results
+
+def CheckTestWorker(task):
+    # the stats of the worker travel back with the results of every test file
+    with Timer("check_file", test=task[1]):
+        results = CheckTest(task)
+    return results, TakeStats()
+
+def CheckAll(options: CheckOptions, jobs: int = 0):
+    # yield the results of every test case, in test order, checked across a pool of processes
+    tasks = [(options, test) for test in GetTestList(os.path.join(options.srcDir, "nasm"))]
+    with multiprocessing.Pool(jobs if jobs > 0 else os.cpu_count(), ResetStats) as pool:
+        for results, stats in pool.imap(CheckTestWorker, tasks, chunksize=16):
+            MergeStats(stats)
+            yield from results
+
+def PrintResult(result: dict):
+    if result["status"] == "stale":
+        print(f"{result['test']} ... Stale snapshot, the source changed since it was taken")
+        return
+    rules = f" (normalized by {', '.join(result['rules'])})" if result["rules"] else ""
+    if result["status"] == "pass":
+        print(f"{result['test']} ... Done{rules}")
+        return
+    print(f"{result['test']} ... {rules}")
+    for line in difflib.unified_diff(result["expected"], result["actual"], "ref", "cur", lineterm="", n=0):
+        print(line)
+    for name, line in result["source"].items():
+        print(f"        {line}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Cross check the objects built by the current nasm.')
+    parser.add_argument("mode", type=str, choices=list(check_modes), help="Compare against nasm ref, gas or the SDM index")
+    parser.add_argument("--output-dir", "-o", type=str, default="output", help="Directory of the built objects")
+    parser.add_argument("--src-dir", "-s", type=str, default="target_src", help="Directory of the generated sources")
+    parser.add_argument("--jobs", "-j", type=int, default=0, help="Number of check processes, 0 uses all CPUs")
+    parser.add_argument("--results", "-r", type=str, help="Write the structured results to this JSON file")
+    parser.add_argument("--db", type=str, help="Record the results as a run in this SQLite result database")
+    parser.add_argument("--label", type=str, help="Label of the run in the result database, e.g. the nasm commit")
+    parser.add_argument("--baseline", "-b", type=str, help="Only report the failures which are not in this baseline, or whose diff changed")
+    parser.add_argument("--save-baseline", type=str, help="Write the failures of this run as a baseline to this file")
+    parser.add_argument("--expand", type=str, help="Write the opcodes with a reported failure to this file, for tc_gen.py --sample --expand")
+    parser.add_argument("--snapshot", type=str, help="Compare nasm.cur against this reference snapshot instead of the reference objects")
+    parser.add_argument("--sdm-index", type=str, default=SDM_INDEX, help="The index of the SDM encodings written by sdm_oracle.py, for the sdm mode")
+    parser.add_argument("--cache-dir", "-c", type=str, help="Directory of the disassembly cache, no cache by default")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024), help="Size limit of the disassembly cache in MiB")
+    parser.add_argument("--stats", type=str, help="Write the counters and timers of the check to this JSON file")
+    parser.add_argument("--trace", type=str, help="Write a Chrome trace of the check to this file")
+    args = parser.parse_args()
+
+    if args.mode == "sdm":
+        if args.snapshot:
+            print("Error: the sdm check takes no snapshot", file=sys.stderr)
+            return 1
+        if not os.path.exists(args.sdm_index):
+            print(f"Error: no SDM index {args.sdm_index}, build it with sdm_oracle.py", file=sys.stderr)
+            return 1
+        print(f"Checking the output of nasm cur against the SDM index {args.sdm_index}")
+    else:
+        print(f"Comparing output between nasm {args.mode if args.mode == 'gas' else 'ref'} and cur")
+    start = time.perf_counter()
+    counts = {"pass": 0, "fail": 0, "stale": 0}
+    rule_counts = {}
+    cache_counts = [0, 0]
+    results = []
+    options = CheckOptions(args.mode, args.output_dir, args.src_dir, args.cache_dir, args.snapshot, args.sdm_index)
+    if args.snapshot:
+        reader = SnapshotReader(args.snapshot)
+        if reader.meta["mode"] != args.mode:
+            print(f"Error: {args.snapshot} is a snapshot for the {reader.meta['mode']} check", file=sys.stderr)
+            return 1
+        print(f"Using the {reader.meta['toolchain']} {reader.meta['version']} snapshot {args.snapshot} as reference")
+        reader.Close()
+    known = {}
+    if args.baseline:
+        baseline = LoadBaseline(args.baseline)
+        if baseline["mode"] != args.mode:
+            print(f"Error: {args.baseline} is a baseline for the {baseline['mode']} check", file=sys.stderr)
+            return 1
+        known = baseline["failures"]
+        print(f"Reporting against the baseline {args.baseline} of {len(known)} known failures")
+    failures = {}
+    passed = set()
+    failing_opcodes = set()
+    for result in CheckAll(options, args.jobs):
+        if result["status"] == "fail":
+            failures[result["test"]] = GetSignature(result["expected"], result["actual"])
+        elif result["status"] == "pass" and result["test"] in known:
+            passed.add(result["test"])
+        # a failure of the baseline with the same diff is not reported again
+        if result["status"] != "fail" or known.get(result["test"]) != failures[result["test"]]:
+            PrintResult(result)
+            if result["status"] == "fail":
+                failing_opcodes.add(GetOpcode(result["test"]))
+        counts[result["status"]] += 1
+        cache_counts[0] += result["cache_hits"]
+        cache_counts[1] += result["cache_misses"]
+        for name in result["rules"]:
+            rule_counts[name] = rule_counts.get(name, 0) + 1
+        if args.results or args.db:
+            results.append(result)
+    seconds = time.perf_counter() - start
+    stale = f", {counts['stale']} with a stale snapshot" if counts["stale"] else ""
+    print(f"{args.mode}: {counts['pass']} passed, {counts['fail']} failed{stale} in {seconds:.2f}s")
+    for name, count in sorted(rule_counts.items()):
+        print(f"{args.mode}: normalization rule '{name}' fired on {count} instructions")
+    without_reference = GetSummary(args.mode)["counters"].get("cases_without_reference", 0)
+    if without_reference:
+        print(f"{args.mode}: {without_reference} cases skipped, rejected by the reference assembler")
+    if args.mode == "sdm":
+        print(f"{args.mode}: {GetSummary(args.mode)['counters'].get('sdm_unknown', 0)} instructions without a form in the SDM index")
+    changes = None
+    if args.baseline:
+        changes = CompareFailures(known, failures, passed)
+        print(f"{args.mode}: {len(changes['new'])} new failures, {len(changes['fixed'])} fixed, "
+              f"{len(changes['changed'])} with a changed diff, {changes['known']} known failures not reported")
+        for kind in ("new", "changed", "fixed"):
+            if changes[kind]:
+                print(f"{args.mode}: {kind}: {' '.join(changes[kind])}")
+    if args.save_baseline:
+        SaveBaseline(args.save_baseline, args.mode, failures, args.label)
+        print(f"{args.mode}: wrote the baseline of {len(failures)} failures to {args.save_baseline}")
+    if args.expand:
+        # a sampled run checks these opcodes again with all their combinations
+        with open(args.expand, 'w') as f:
+            f.write("".join(f"{opcode}\n" for opcode in sorted(failing_opcodes)))
+        print(f"{args.mode}: {len(failing_opcodes)} opcodes with failures written to {args.expand}")
+    if args.cache_dir:
+        evicted = EvictCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        print(f"{args.mode}: disassembly cache {cache_counts[0]} hits, {cache_counts[1]} misses, {evicted} entries evicted")
+
+    if args.results:
+        with open(args.results, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.db:
+        conn = OpenDatabase(args.db)
+        run_id = RecordRun(conn, args.mode, results, LoadFamilyIndex(args.src_dir), args.label)
+        conn.close()
+        print(f"{args.mode}: recorded as run {run_id} in {args.db}")
+    WriteStats(f"check_{args.mode}", args.stats, args.trace)
+    # against a baseline, a new failure or a changed diff fails the check
+    return 1 if changes and (changes["new"] or changes["changed"]) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,16 @@
 import os
 import re
 import json
+import itertools
+import multiprocessing
+import hashlib
+import math
+import marshal
+import random
+import collections
+from typing import NamedTuple
+
+from instrument import Count, Timer, TakeStats, ResetStats, MergeStats, WriteStats
 
 NASM_HEADER = """
         bits 64
@@ -35,9 +45,47 @@ near1:
         ret
 """
 
+# batched test files carry one test_<opcode>_<i> label per instruction, the jump target is renamed per label
+# so that short jumps stay in range and every case keeps the encoding of a single test file
+NASM_BATCH_HEADER = """
+        bits 64
+        section .text
+"""
+NASM_BATCH_CASE = """
+        global test_%s
+test_%s:
+        %s
+near1_%s:
+        nop
+"""
+NASM_BATCH_FOOTER = """
+        ret
+"""
+
+GAS_BATCH_HEADER = """
+        .text
+"""
+GAS_BATCH_CASE = """
+        .globl  test_%s
+test_%s:
+        %s
+near1_%s:
+        nop
+"""
+GAS_BATCH_FOOTER = """
+        ret
+"""
+
 NASM = 0
 GAS = 1
 
+MANIFEST_FILE = "manifest.json"
+
+isa_families = ["LEGACY", "VEX", "EVEX", "APX"]
+
+target_names = ["nasm", "gas"]
+target_suffixes = ["_nasm.asm", "_gas.s"]
+
 operand_to_nasm_gas_mapping = {
     "bndreg"           : [[ "bnd1"],
                           ["%bnd1"]],
@@ -665,8 +713,10 @@ blacklist_non_intel_opcodes = [
     "XSTORE"
 ]
 
+# every spelling nasm accepts is its own test case, the condition code aliases (JZ/JE, SETNAE/SETB, ...)
+# included, so a broken alias in nasm's tables is caught; objdump prints the same mnemonic for both
 opcode_translation_table = {
-    "CCMPscc"   : ["CCMPB", "CCMPBE", "CCMPBE", "CCMPF", "CCMPL", "CCMPLE", "CCMPNB", "CCMPNBE",
+    "CCMPscc"   : ["CCMPB", "CCMPBE", "CCMPF", "CCMPL", "CCMPLE", "CCMPNB", "CCMPNBE",
                     "CCMPNL", "CCMPNLE", "CCMPNO", "CCMPNS", "CCMPNZ", "CCMPO", "CCMPS", "CCMPT", "CCMPZ"],
     "CFCMOVcc"  : ["CFCMOVB", "CFCMOVBE", "CFCMOVL", "CFCMOVLE", "CFCMOVNB", "CFCMOVNBE",
                     "CFCMOVNL", "CFCMOVNLE", "CFCMOVNO", "CFCMOVNP", "CFCMOVNS", "CFCMOVNZ",
@@ -683,10 +733,7 @@ opcode_translation_table = {
                     "CTESTT", "CTESTZ"],
     "Jcc"       : ["JA", "JAE", "JB", "JBE", "JC", "JCXZ", "JECXZ", "JE", "JG", "JGE", "JL", "JLE",
                     "JNA", "JNAE", "JNB", "JNBE", "JNC", "JNE", "JNG", "JNGE", "JNL", "JNLE",
-                    "JNO", "JNP", "JNS", "JNZ", "JO", "JP", "JPE", "JPO", "JS", "JZ", "JA", "JAE",
-                    "JB", "JBE", "JC", "JE", "JZ", "JG", "JGE", "JL", "JLE", "JNA", "JNAE", "JNB",
-                    "JNBE", "JNC", "JNE", "JNG", "JNGE", "JNL", "JNLE", "JNO", "JNP", "JNS", "JNZ",
-                    "JO", "JP", "JPE", "JPO", "JS", "JZ"],
+                    "JNO", "JNP", "JNS", "JNZ", "JO", "JP", "JPE", "JPO", "JS", "JZ"],
     "SETcc"     : ["SETA", "SETAE", "SETB", "SETBE", "SETC", "SETE", "SETG", "SETGE", "SETL",
                     "SETLE", "SETNA", "SETNAE", "SETNB", "SETNBE", "SETNC", "SETNE", "SETNG",
                     "SETNGE", "SETNL", "SETNLE", "SETNO", "SETNP", "SETNS", "SETNZ", "SETO",
@@ -704,30 +751,67 @@ def SplitOperands(operandStr):
     parts = re.split(r',', operandStr)
     return [part.strip() for part in parts]
 
-def ExtractUniqueColumn(filename, column=0):
-    column_set = set()
-    with open(filename, 'r') as f:
-        for line in f:
-            line = line.split(';', 1)[0]  # Remove comments
-            if not line.strip():          # Skip empty lines
-                continue
-            column_set.add(line.split()[column])
-    return list(column_set)
+class XdaRecord(NamedTuple):
+    opcode: str
+    operands: str
+    encoding: str
+    flags: str
+    line: str
+
+def ParseXdaLine(line: str):
+    line = line.split(';', 1)[0]  # Remove comments
+    if not line.strip():          # Skip empty lines
+        return None
+    fields = line.split()
+    encoding = ""
+    flags = ""
+    start = line.find('[')
+    end = line.find(']', start + 1)
+    if start != -1 and end != -1:
+        encoding = line[start + 1:end].strip()
+        flags = line[end + 1:].strip()
+    elif len(fields) > 2:
+        flags = fields[-1]
+    return XdaRecord(fields[0], fields[1] if len(fields) > 1 else "", encoding, flags, line)
+
+def IndexXdaRecords(lines):
+    # index the records by opcode, keeping the file order
+    xdaDb = {}
+    for line in lines:
+        record = ParseXdaLine(line)
+        if record is None:
+            continue
+        xdaDb.setdefault(record.opcode, []).append(record)
+    return xdaDb
+
+def LoadXdaDatabase(xdaFile):
+    # read the xda file once
+    with open(xdaFile, 'r') as f:
+        return IndexXdaRecords(f)
 
-def GetOpcodeList(xdaFile):
-    return ExtractUniqueColumn(xdaFile, 0)
+def GetOpcodeList(xdaDb):
+    return list(xdaDb.keys())
 
-def GetOperandList(xdaFile):
-    return ExtractUniqueColumn(xdaFile, 1)
+def GetOperandList(xdaDb):
+    operand_set = {}
+    for records in xdaDb.values():
+        for record in records:
+            operand_set[record.operands] = None
+    return list(operand_set.keys())
+
+def GetBlacklistMessage(opcode):
+    if opcode in blacklist_non_64bit_opcodes:
+        return f"Skipping non-64bit opcode '{opcode}'"
+    if opcode in blacklist_non_intel_opcodes:
+        return f"Skipping non-Intel opcode '{opcode}'"
+    return None
 
 def RemoveBlacklistedOpcodes(opcodeList):
     filtered_opcodes = []
     for opcode in opcodeList:
-        if opcode in blacklist_non_64bit_opcodes:
-            print(f"Skipping non-64bit opcode '{opcode}'")
-            continue
-        if opcode in blacklist_non_intel_opcodes:
-            print(f"Skipping non-Intel opcode '{opcode}'")
+        message = GetBlacklistMessage(opcode)
+        if message:
+            print(message)
             continue
         filtered_opcodes.append(opcode)
     return filtered_opcodes
@@ -750,96 +834,418 @@ def GetOpcodeAndPrefix(line: str, opcode: str):
 
     return opcodesEx, prefix
 
-def PopulateOperandMapping(operandList: list, pos: int, temp: list, outputOperands: list, dir: int):
+def PopulateOperandMapping(operandList: list, pos: int, temp: list, dir: int):
+    # yield the operand combinations one by one instead of building the whole cartesian product
     for operand in operandList[pos]:
         temp[pos] = operand
         #print(f"Position {pos}, Operand: {operand}, Temp: {temp}")
         if pos + dir >= len(operandList) or pos + dir < 0: # Last position
             #print(f"Adding combination to output: {temp}")
-            outputOperands.append(temp.copy())
+            yield temp.copy()
+        else:
+            yield from PopulateOperandMapping(operandList, pos + dir, temp, dir)
+
+# operand list of a record -> its paired NASM/GAS alternatives, or the first operand without a mapping
+paired_operand_cache = {}
+
+def PairOperands(operandStr):
+    paired_operands = []
+    for operand in SplitOperands(operandStr):
+        mapping = operand_to_nasm_gas_mapping.get(operand)
+        if mapping and mapping[NASM] and mapping[GAS]:
+            paired_operands.append(list(zip(mapping[NASM], mapping[GAS])))
         else:
-            PopulateOperandMapping(operandList, pos + dir, temp, outputOperands, dir)
-            
-    return outputOperands
+            return operand
+    return paired_operands
+
+def GetPairedOperands(record: XdaRecord):
+    paired_operands = paired_operand_cache.get(record.operands)
+    if paired_operands is None:
+        paired_operands = paired_operand_cache[record.operands] = PairOperands(record.operands)
+    if isinstance(paired_operands, str):
+        print(f"Warning: No NASM/GAS mapping for operand '{paired_operands}' in opcode '{record.opcode}'")
+        return None
+    return paired_operands
+
+def RenderInstructionPair(prefix: str, opcodeEx: str, combination: list):
+    nasm_operands_list = [pair[NASM] for pair in combination]
+    gas_operands_list = [pair[GAS] for pair in reversed(combination)]
+    nasm_operands_list.remove("") if "" in nasm_operands_list else None
+    gas_operands_list.remove("") if "" in gas_operands_list else None
+    # move '{dfv=...}' from the operands to a suffix of the opcode,
+    # it is the first operand for NASM and the last one for GAS
+    nasm_suffix = ""
+    if nasm_operands_list and '{dfv=' in nasm_operands_list[0]:
+        nasm_suffix = nasm_operands_list.pop(0)
+    gas_suffix = ""
+    if gas_operands_list and '{dfv=' in gas_operands_list[-1]:
+        gas_suffix = gas_operands_list.pop(-1)
+    nasm_instruction = f"{prefix}{opcodeEx} {nasm_suffix} " + ", ".join(nasm_operands_list)
+    gas_instruction = f"{prefix}{opcodeEx} {gas_suffix} " + ", ".join(gas_operands_list)
+    return nasm_instruction, gas_instruction
+
+def GetIsaFamily(record: XdaRecord):
+    if "APX" in record.flags.split(","):
+        return "APX"
+    if "evex." in record.encoding:
+        return "EVEX"
+    if "vex." in record.encoding or "vex+." in record.encoding:
+        return "VEX"
+    return "LEGACY"
+
+def GetCombinationCount(opcodesEx, paired_operands):
+    return len(opcodesEx) * math.prod(len(alternatives) for alternatives in paired_operands)
 
-def GenerateNasmInstructions(opcodes, xdaFile):
-    nasm_instructions = []
+def GetFamilyRuns(opcode, xdaDb):
+    # the ISA family of every case index of an opcode, run-length encoded as [[family, count], ...]
+    runs = []
+    for record in xdaDb.get(opcode, []):
+        opcodesEx, _ = GetOpcodeAndPrefix(record.line, opcode)
+        paired_operands = GetPairedOperands(record)
+        if paired_operands is None:
+            continue
+        count = GetCombinationCount(opcodesEx, paired_operands)
+        family = GetIsaFamily(record)
+        if runs and runs[-1][0] == family:
+            runs[-1][1] += count
+        elif count:
+            runs.append([family, count])
+    return runs
+
+def GetCaseFamily(runs, index):
+    for family, count in runs:
+        if index < count:
+            return family
+        index -= count
+    return None
+
+def IterInstructionCases(opcode, xdaDb, family=None, indexes=None):
+    # expand every operand combination once and render the NASM and GAS text side by side,
+    # so test_X_i_nasm and test_X_i_gas always come from the same combination; yields
+    # (opcode, index, pair), with a family or sampled indexes given only those cases are
+    # rendered but the indexes stay those of the whole opcode
+    index = 0
+    if indexes is not None:
+        indexes = set(indexes)
+    for record in xdaDb.get(opcode, []):
+        opcodesEx, prefix = GetOpcodeAndPrefix(record.line, opcode)
+        paired_operands = GetPairedOperands(record)
+        if paired_operands is None:
+            print(f"Skipping line '{record.line}' due to missing operand mappings")
+            continue
+        count = GetCombinationCount(opcodesEx, paired_operands)
+        if ((family is not None and GetIsaFamily(record) != family) or
+            (indexes is not None and not any(index <= i < index + count for i in indexes))):
+            index += count
+            continue
+        for opcodeEx in opcodesEx:
+            temp = [None] * len(paired_operands)
+            for combination in PopulateOperandMapping(paired_operands, 0, temp, 1):
+                if indexes is None or index in indexes:
+                    Count("combinations_expanded")
+                    yield opcode, index, RenderInstructionPair(prefix, opcodeEx, combination)
+                index += 1
+
+def IterInstructionPairs(opcode, xdaDb):
+    for _, _, pair in IterInstructionCases(opcode, xdaDb):
+        yield pair
+
+def RenderTestFiles(name, cases, targets, batch=1):
+    # yield (target, file name, file content, instruction count) for every test file of a group of
+    # (opcode, index, pair) cases, pulling at most one batch of cases at a time; batch 0 puts the
+    # whole group into one file
+    cases = iter(cases)
+    for b in itertools.count():
+        chunk = list(itertools.islice(cases, batch) if batch > 0 else cases)
+        if not chunk:
+            return
+        for target in targets:
+            suffix = target_suffixes[target]
+            if batch == 1:
+                opcode, i, pair = chunk[0]
+                header, footer = (NASM_HEADER, NASM_FOOTER) if target == NASM else (GAS_HEADER, GAS_FOOTER)
+                yield target, f"test_{opcode}_{i}{suffix}", header % (opcode, opcode) + f"        {pair[target]}\n" + footer, 1
+                continue
+            header, case, footer = ((NASM_BATCH_HEADER, NASM_BATCH_CASE, NASM_BATCH_FOOTER) if target == NASM else
+                                    (GAS_BATCH_HEADER, GAS_BATCH_CASE, GAS_BATCH_FOOTER))
+            content = [header]
+            for opcode, i, pair in chunk:
+                label = f"{opcode}_{i}"
+                insn = re.sub(r'\bnear1\b', f"near1_{label}", pair[target])
+                content.append(case % (label, label, insn, label))
+            content.append(footer)
+            yield target, f"test_{name}_b{b}{suffix}", "".join(content), len(chunk)
+
+def GetGroupCases(unit, xdaDb, group, opcodes, sample=None):
+    # the cases of one output unit: an opcode, or one ISA family across all opcodes; with a sample
+    # only its cases of the sampled opcodes
+    sample = sample or {}
+    if group == "opcode":
+        return IterInstructionCases(unit, xdaDb, None, sample.get(unit))
+    family = unit[len("family_"):]
+    return itertools.chain.from_iterable(IterInstructionCases(opcode, xdaDb, family, sample.get(opcode)) for opcode in opcodes)
+
+def GetGroupUnits(opcodes, group):
+    return opcodes if group == "opcode" else [f"family_{family}" for family in isa_families]
+
+def GetShard(unit, shards):
+    # the shard of an output unit, stable across runs and hosts: a family unit goes by its family,
+    # an opcode by its name hash
+    if unit.startswith("family_"):
+        return isa_families.index(unit[len("family_"):]) % shards
+    return int(hashlib.sha1(unit.encode()).hexdigest()[:8], 16) % shards
+
+def ParseShard(value):
+    # "K/N" -> (K, N)
+    index, _, count = value.partition("/")
+    if not index.isdigit() or not count.isdigit() or not 0 <= int(index) < int(count):
+        raise ValueError(f"invalid shard '{value}', expected K/N with 0 <= K < N")
+    return int(index), int(count)
+
+def GetOpcodeHash(opcode, xdaDb, batch):
+    # hash everything the test files of an opcode are rendered from
+    records = xdaDb.get(opcode, [])
+    operands = sorted({operand for record in records for operand in SplitOperands(record.operands)})
+    state = [batch,
+             [NASM_HEADER, NASM_FOOTER, GAS_HEADER, GAS_FOOTER],
+             [NASM_BATCH_HEADER, NASM_BATCH_CASE, NASM_BATCH_FOOTER, GAS_BATCH_HEADER, GAS_BATCH_CASE, GAS_BATCH_FOOTER],
+             [record.line for record in records],
+             {operand: operand_to_nasm_gas_mapping.get(operand) for operand in operands},
+             opcode_translation_table.get(opcode),
+             prefix_by_opcode_table.get(opcode)]
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+def GetUnitHash(unit, xdaDb, batch, group, opcodes, sample=None):
+    sample = sample or {}
+    if group == "opcode":
+        if unit not in sample:
+            return GetOpcodeHash(unit, xdaDb, batch)
+        opcodes = [unit]
+    state = [unit, [GetOpcodeHash(opcode, xdaDb, batch) for opcode in opcodes], [sample.get(opcode) for opcode in opcodes]]
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+def GetPrefixClass(prefix):
+    for prefix_class in ("{evex}", "{vex}"):
+        if prefix.startswith(prefix_class):
+            return prefix_class
+    return "legacy"
+
+def SampleCases(opcodes, xdaDb, seed):
+    # a seeded subset of the cases covering every xda line, every alternative of every operand type
+    # and every prefix class at least once; returns {opcode: sorted case indexes} with the indexes
+    # of the full run, the case count of every opcode and the coverage as {goal: [covered, total]}
+    rng = random.Random(seed)
+    counts = {}
+    lines = []  # [opcode, first case index, opcode variants, operand types, alternatives per operand, prefix class]
     for opcode in opcodes:
-        all_instruction_combinations = []
-        with open(xdaFile, 'r') as f:
-            for line in f:
-                line = line.split(';', 1)[0]
-                if not line.strip():
-                    continue
-                if line.split()[0] == opcode:
-                    opcodesEx, prefix = GetOpcodeAndPrefix(line, opcode)
-                    operandStr = line.split()[1]
-                    operands = SplitOperands(operandStr)
-                    nasm_operands = []
-                    for operand in operands:
-                        if operand in operand_to_nasm_gas_mapping and operand_to_nasm_gas_mapping[operand][NASM]:
-                            nasm_operands.append(operand_to_nasm_gas_mapping[operand][NASM])
-                        else:
-                            print(f"Warning: No NASM mapping for operand '{operand}' in opcode '{opcode}'")
-                            break
-                    if len(operands) != len(nasm_operands):
-                        print(f"Skipping line '{line}' due to missing operand mappings")
-                        continue
-                    temp = [None] * len(nasm_operands)
-                    all_operand_combinations = PopulateOperandMapping(nasm_operands, 0, temp, [], 1)
-                    for opcodeEx in opcodesEx:
-                        for nasm_operand_combination in all_operand_combinations:
-                            nasm_operand_combination.remove("") if "" in nasm_operand_combination else None
-                            suffix = ""
-                            # remove the first element if the first element includes string '{dfv=...}' and put it as a suffix to opcode
-                            operands_list = nasm_operand_combination.copy()
-                            if operands_list and '{dfv=' in operands_list[0]:
-                                suffix = operands_list[0]
-                                operands_list.pop(0)
-                            nasm_instruction = f"{prefix}{opcodeEx} {suffix} " + ", ".join(operands_list)
-                            all_instruction_combinations.append(nasm_instruction)
-        #print (opcode, all_instruction_combinations)
-        nasm_instructions.append({opcode: all_instruction_combinations})
-    return nasm_instructions
-
-def GenerateGasInstructions(opcodes, xdaFile):
-    gas_instructions = []
+        index = 0
+        for record in xdaDb.get(opcode, []):
+            opcodesEx, prefix = GetOpcodeAndPrefix(record.line, opcode)
+            paired_operands = GetPairedOperands(record)
+            if paired_operands is None:
+                continue
+            count = GetCombinationCount(opcodesEx, paired_operands)
+            if count:
+                lines.append([opcode, index, len(opcodesEx), SplitOperands(record.operands),
+                              [len(alternatives) for alternatives in paired_operands], GetPrefixClass(prefix)])
+            index += count
+        counts[opcode] = index
+    forms = {(operand, alt): None for line in lines for operand, n in zip(line[3], line[4]) for alt in range(n)}
+    classes = {line[5]: None for line in lines}
+    covered = set()
+    sample = {}
+
+    def Pick(line, fixed=None):
+        # one case of a line, preferring operand alternatives not covered yet
+        opcode, index, variants, operands, sizes, prefix_class = line
+        choice = []
+        for pos, (operand, n) in enumerate(zip(operands, sizes)):
+            if fixed and fixed[0] == pos:
+                choice.append(fixed[1])
+                continue
+            uncovered = [alt for alt in range(n) if (operand, alt) not in covered]
+            choice.append(rng.choice(uncovered or range(n)))
+        case = rng.randrange(variants)
+        for alt, n in zip(choice, sizes):
+            case = case * n + alt
+        sample.setdefault(opcode, set()).add(index + case)
+        covered.update(zip(operands, choice))
+        covered.add(prefix_class)
+
+    for line in lines:
+        Pick(line)
+    for operand, alt in forms:
+        if (operand, alt) not in covered:
+            line = rng.choice([line for line in lines if operand in line[3]])
+            Pick(line, (line[3].index(operand), alt))
+    for prefix_class in classes:
+        if prefix_class not in covered:
+            Pick(rng.choice([line for line in lines if line[5] == prefix_class]))
+    coverage = {"xda lines": [len(lines), len(lines)],
+                "operand forms": [sum(1 for form in forms if form in covered), len(forms)],
+                "prefix classes": [sum(1 for prefix_class in classes if prefix_class in covered), len(classes)]}
+    return {opcode: sorted(indexes) for opcode, indexes in sample.items()}, counts, coverage
+
+def NormalizeXdaLine(line):
+    return " ".join(line.split())
+
+def LoadXdaChanges(path, xdaDb):
+    # the xda lines added and removed per opcode, as {opcode: Counter of lines}, from the xda file
+    # before the change or from a unified diff of it; a line only moved or recommented is no change
+    old, new = {}, {}
+    with open(path, 'r') as f:
+        text = f.read()
+    if text.startswith(("diff ", "--- ", "Index: ")):
+        changes = [(new if line[0] == "+" else old, line[1:]) for line in text.splitlines()
+                   if line[:1] in ("+", "-") and not line.startswith(("+++", "---"))]
+    else:
+        changes = [(old, line) for line in text.splitlines()]
+        changes += [(new, record.line) for records in xdaDb.values() for record in records]
+    for lines, line in changes:
+        record = ParseXdaLine(line)
+        if record is not None:
+            lines.setdefault(record.opcode, collections.Counter())[NormalizeXdaLine(record.line)] += 1
+    added = {opcode: lines - old.get(opcode, collections.Counter()) for opcode, lines in new.items()}
+    removed = {opcode: lines - new.get(opcode, collections.Counter()) for opcode, lines in old.items()}
+    return {opcode: lines for opcode, lines in added.items() if lines}, {opcode: lines for opcode, lines in removed.items() if lines}
+
+def SelectChangedCases(opcodes, xdaDb, added, removed, seed, control):
+    # all cases of the xda lines added or changed, all cases of an opcode which lost a line since
+    # its indexes moved, and one sampled case per line of `control` unchanged opcodes picked at
+    # random; returns {opcode: case indexes, None for all}, the operand classes of the changed
+    # lines and the control opcodes
+    selected = {}
+    operand_classes = {}
     for opcode in opcodes:
-        all_instruction_combinations = []
-        with open(xdaFile, 'r') as f:
-            for line in f:
-                line = line.split(';', 1)[0]
-                if not line.strip():
-                    continue
-                if line.split()[0] == opcode:
-                    opcodesEx, prefix = GetOpcodeAndPrefix(line, opcode)
-                    operandStr = line.split()[1]
-                    operands = SplitOperands(operandStr)
-                    gas_operands = []
-                    for operand in operands:
-                        if operand in operand_to_nasm_gas_mapping and operand_to_nasm_gas_mapping[operand][GAS]:
-                            gas_operands.insert(0, operand_to_nasm_gas_mapping[operand][GAS])
-                        else:
-                            print(f"Warning: No GAS mapping for operand '{operand}' in opcode '{opcode}'")
-                            break
-                    if len(operands) != len(gas_operands):
-                        print(f"Skipping line '{line}' due to missing operand mappings")
-                        continue
-                    temp = [None] * len(gas_operands)
-                    all_operand_combinations = PopulateOperandMapping(gas_operands, len(gas_operands) - 1, temp, [], -1)
-                    for opcodeEx in opcodesEx:
-                        for gas_operand_combination in all_operand_combinations:
-                            gas_operand_combination.remove("") if "" in gas_operand_combination else None
-                            suffix = ""
-                            # remove the last element if the last element includes string '{dfv=...}' and put it as a suffix to opcode
-                            operands_list = gas_operand_combination.copy()
-                            if operands_list and '{dfv=' in operands_list[-1]:
-                                suffix = operands_list[-1]
-                                operands_list.pop(-1)
-                            gas_instruction = f"{prefix}{opcodeEx} {suffix} " + ", ".join(operands_list)
-                            all_instruction_combinations.append(gas_instruction)
-        gas_instructions.append({opcode: all_instruction_combinations})
-    return gas_instructions
+        for line in removed.get(opcode, ()):
+            selected[opcode] = None
+            operand_classes.update(dict.fromkeys(SplitOperands(ParseXdaLine(line).operands)))
+        index = 0
+        for record in xdaDb.get(opcode, []):
+            opcodesEx, _ = GetOpcodeAndPrefix(record.line, opcode)
+            paired_operands = GetPairedOperands(record)
+            if paired_operands is None:
+                continue
+            count = GetCombinationCount(opcodesEx, paired_operands)
+            if NormalizeXdaLine(record.line) in added.get(opcode, ()):
+                operand_classes.update(dict.fromkeys(SplitOperands(record.operands)))
+                if selected.get(opcode, []) is not None:
+                    selected.setdefault(opcode, []).extend(range(index, index + count))
+            index += count
+    rng = random.Random(seed)
+    unchanged = [opcode for opcode in opcodes if opcode not in selected]
+    control_opcodes = rng.sample(unchanged, min(control, len(unchanged)))
+    selected.update(SampleCases(control_opcodes, xdaDb, seed)[0])
+    return selected, list(operand_classes), control_opcodes
+
+def GetGeneratorHash():
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def CompileXda(text):
+    # the records as plain tuples, the opcodes left after the blacklists with the messages about the
+    # others, and the paired alternatives of every operand list
+    xdaDb = IndexXdaRecords(text.splitlines(True))
+    opcodes = GetOpcodeList(xdaDb)
+    skipped = [GetBlacklistMessage(opcode) for opcode in opcodes if GetBlacklistMessage(opcode)]
+    opcodes = [opcode for opcode in opcodes if not GetBlacklistMessage(opcode)]
+    return {"records": {opcode: [tuple(record) for record in records] for opcode, records in xdaDb.items()},
+            "opcodes": opcodes, "skipped": skipped,
+            "paired": {operands: PairOperands(operands) for operands in GetOperandList(xdaDb)}}
+
+def LoadCompiledXda(xdaFile, cacheDir, generatorHash):
+    # the parsed xda file with the blacklists applied and the operand alternatives paired, read with a
+    # single read from the cache while neither the xda file nor the generator changed
+    with open(xdaFile, 'rb') as f:
+        data = f.read()
+    path_key = hashlib.sha1(os.path.abspath(xdaFile).encode()).hexdigest()[:8]
+    key = hashlib.sha256(data + generatorHash.encode()).hexdigest()[:32]
+    cache_path = os.path.join(cacheDir, f"xda_{path_key}_{key}.bin") if cacheDir else None
+    compiled = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                compiled = marshal.loads(f.read())
+            Count("xda_cache_hits")
+        except (EOFError, ValueError, TypeError):
+            compiled = None
+    if compiled is None:
+        compiled = CompileXda(data.decode())
+        if cache_path:
+            Count("xda_cache_misses")
+            os.makedirs(cacheDir, exist_ok=True)
+            # the entries of earlier versions of the same xda file are stale
+            for name in os.listdir(cacheDir):
+                if name.startswith(f"xda_{path_key}_"):
+                    os.remove(os.path.join(cacheDir, name))
+            with open(cache_path + f".{os.getpid()}.tmp", 'wb') as f:
+                f.write(marshal.dumps(compiled))
+            os.replace(cache_path + f".{os.getpid()}.tmp", cache_path)
+    for message in compiled["skipped"]:
+        print(message)
+    paired_operand_cache.update(compiled["paired"])
+    return {opcode: [XdaRecord(*record) for record in records] for opcode, records in compiled["records"].items()}, compiled["opcodes"]
+
+def LoadManifest(outputDir, target):
+    manifest_path = os.path.join(outputDir, target_names[target], MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {"generator": None, "opcodes": {}}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def SaveManifest(outputDir, target, manifest):
+    manifest_path = os.path.join(outputDir, target_names[target], MANIFEST_FILE)
+    with open(manifest_path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def RemoveTestFiles(outputDir, target, names):
+    for name in names:
+        target_path = os.path.join(outputDir, target_names[target], name)
+        if os.path.exists(target_path):
+            os.remove(target_path)
+
+def WriteTestFiles(unit, xdaDb, targets, batch, outputDir, previous=None, group="opcode", opcodes=None, sample=None):
+    # write the test files of one opcode or ISA family and return its instruction count with the new
+    # manifest entries; with the previous entries given, only files whose content changed are rewritten
+    opcode_hash = GetUnitHash(unit, xdaDb, batch, group, opcodes, sample)
+    if previous and all(previous.get(target) and previous[target]["hash"] == opcode_hash and
+                        all(os.path.exists(os.path.join(outputDir, target_names[target], name))
+                            for name in previous[target]["files"]) for target in targets):
+        Count("units_unchanged")
+        return previous[targets[0]]["count"], previous
+    with Timer("write_unit", unit=unit):
+        entries = {target: {"hash": opcode_hash, "count": 0, "files": {}} for target in targets}
+        for target, name, content, n in RenderTestFiles(unit, GetGroupCases(unit, xdaDb, group, opcodes, sample), targets, batch):
+            digest = hashlib.sha256(content.encode()).hexdigest()
+            entries[target]["files"][name] = digest
+            entries[target]["count"] += n
+            target_path = os.path.join(outputDir, target_names[target], name)
+            if previous and previous.get(target) and previous[target]["files"].get(name) == digest and os.path.exists(target_path):
+                Count("files_unchanged")
+                continue
+            with open(target_path, 'w') as f:
+                f.write(content)
+            Count("files_written")
+        if group == "opcode":
+            # the family of every case, for the result database; a family unit is named after its family
+            for target in targets:
+                entries[target]["families"] = GetFamilyRuns(unit, xdaDb)
+        for target in targets:
+            if previous and previous.get(target):
+                RemoveTestFiles(outputDir, target, set(previous[target]["files"]) - set(entries[target]["files"]))
+        return entries[targets[0]]["count"], entries
+
+worker_args = {}
+
+def InitWorker(xdaDb, targets, batch, outputDir, group, opcodes, sample):
+    ResetStats()
+    worker_args.update(xdaDb=xdaDb, targets=targets, batch=batch, outputDir=outputDir, group=group, opcodes=opcodes, sample=sample)
+
+def WriteTestFilesWorker(task):
+    # the stats of the worker travel back with every result
+    opcode, previous = task
+    return opcode, WriteTestFiles(opcode, previous=previous, **worker_args), TakeStats()
 
 if __name__ == "__main__":
     import argparse
@@ -847,12 +1253,29 @@ if __name__ == "__main__":
     parser.add_argument("--xdafile", "-i", type=str, default="../x86/insns.xda", help="The instruction database from nasm")
     # add an argument "--target"
     parser.add_argument("--target", "-t", type=str, choices=["nasm", "gas", "both"], default="both", help="The target assembler to generate test files for")
+    parser.add_argument("--batch", "-b", type=int, default=1, help="Number of instructions per test file, each under its own test_<opcode>_<i> label, 0 puts a whole group into one file")
+    parser.add_argument("--group", "-g", type=str, choices=["opcode", "family"], default="opcode", help="Group batched test files per opcode or per ISA family (LEGACY, VEX, EVEX, APX)")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="Number of worker processes generating opcodes in parallel, 0 uses all CPUs")
+    parser.add_argument("--shard", type=ParseShard, help="Only generate shard K of N, written K/N, the opcodes or families of a shard are fixed by their names")
+    select = parser.add_mutually_exclusive_group()
+    select.add_argument("--sample", action="store_true", help="Only generate a seeded sample covering every xda line, operand form and prefix class")
+    select.add_argument("--changed-from", type=str, help="Only generate the xda lines changed since this xda file or in this unified diff of it, plus a control sample")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sample, the same seed picks the same cases")
+    parser.add_argument("--expand", type=str, help="File of opcodes, one per line, generated with all their combinations in a sampled run")
+    parser.add_argument("--control", type=int, default=4, help="Number of unchanged opcodes sampled as a control with --changed-from")
+    parser.add_argument("--incremental", action="store_true", help="Only rewrite test files whose content changed since the last run and remove stale ones")
+    parser.add_argument("--xda-cache", type=str, default=".cache/xda", help="Directory of the compiled xda file, an empty string disables it")
+    parser.add_argument("--stats", type=str, help="Write the counters and timers of the run to this JSON file")
+    parser.add_argument("--trace", type=str, help="Write a Chrome trace of the run to this file")
     args = parser.parse_args()
 
-    opcodes = GetOpcodeList(args.xdafile)
-    opcodes = RemoveBlacklistedOpcodes(opcodes)
+    generator_hash = GetGeneratorHash()
+    with Timer("load_xda"):
+        xdaDb, opcodes = LoadCompiledXda(args.xdafile, args.xda_cache, generator_hash)
+    Count("records_parsed", sum(len(records) for records in xdaDb.values()))
+    Count("opcodes_parsed", len(opcodes))
     #opcodes = ["AADD"] # For testing
-    operands = GetOperandList(args.xdafile)
+    operands = GetOperandList(xdaDb)
 
     print(f"Found {len(opcodes)} opcodes and {len(operands)} operands in {args.xdafile}")
     #print("Opcodes:")
@@ -862,30 +1285,84 @@ if __name__ == "__main__":
     #for op in operands:
     #    print(f'    "{op}",')
 
-    if args.target in ["nasm", "both"]:
-        nasm_instructions = GenerateNasmInstructions(opcodes, args.xdafile)
-        #json_str = json.dumps(nasm_instructions, indent=2)
-        #print(f"Generated NASM instructions:\n{json_str}\n")
-        for instruction in nasm_instructions:
-            for opcode, insns in instruction.items():
-                print (f"Generating NASM test file for opcode '{opcode}' with {len(insns)} instructions\n")
-                for i in range(len(insns)):
-                    target_path = os.path.join(os.getcwd(), "target_src", "nasm", f"test_{opcode}_{i}_nasm.asm")
-                    with open(target_path, 'w') as f:
-                        f.write(NASM_HEADER % (opcode, opcode))
-                        f.write(f"        {insns[i]}\n")
-                        f.write(NASM_FOOTER)
-
-    if args.target in ["gas", "both"]:
-        gas_instructions = GenerateGasInstructions(opcodes, args.xdafile)
-        #json_str = json.dumps(gas_instructions, indent=2)
-        #print(f"Generated GAS instructions:\n{json_str}\n")
-        for instruction in gas_instructions:
-            for opcode, insns in instruction.items():
-                print (f"Generating GAS test file for opcode '{opcode}' with {len(insns)} instructions\n")
-                for i in range(len(insns)):
-                    target_path = os.path.join(os.getcwd(), "target_src", "gas", f"test_{opcode}_{i}_gas.s")
-                    with open(target_path, 'w') as f:
-                        f.write(GAS_HEADER % (opcode, opcode))
-                        f.write(f"        {insns[i]}\n")
-                        f.write(GAS_FOOTER)
+    targets = [target for target in [NASM, GAS] if args.target in [target_names[target], "both"]]
+    outputDir = os.path.join(os.getcwd(), "target_src")
+    # the manifests record the hash and files of every opcode, an incremental run skips unchanged
+    # opcodes, only rewrites files whose content changed and removes the stale ones
+    manifests = {target: LoadManifest(outputDir, target) for target in targets}
+    def GetPrevious(opcode):
+        if not args.incremental:
+            return None
+        previous = {}
+        for target in targets:
+            entry = manifests[target]["opcodes"].get(opcode)
+            if entry and manifests[target]["generator"] != generator_hash:
+                entry = dict(entry, hash=None)  # the generator changed, render again but keep the file hashes
+            previous[target] = entry
+        return previous
+    sample = None
+    if args.sample:
+        # sampled over all opcodes before sharding, so every shard gets its part of the same sample
+        with Timer("sample"):
+            sample, counts, coverage = SampleCases(opcodes, xdaDb, args.seed)
+        expanded = []
+        if args.expand:
+            with open(args.expand, 'r') as f:
+                expanded = [opcode for opcode in f.read().split() if sample.pop(opcode, None) is not None]
+        sampled = sum(len(indexes) for indexes in sample.values()) + sum(counts[opcode] for opcode in expanded)
+        Count("cases_sampled", sampled)
+        print(f"Sampled {sampled} of {sum(counts.values())} instructions with seed {args.seed}, covering " +
+              ", ".join(f"{covered}/{count} {goal}" for goal, (covered, count) in coverage.items()))
+        if expanded:
+            print(f"Expanding {len(expanded)} opcodes to all their combinations: {' '.join(expanded)}")
+    elif args.changed_from:
+        with Timer("select"):
+            added, removed = LoadXdaChanges(args.changed_from, xdaDb)
+            selected, operand_classes, control = SelectChangedCases(opcodes, xdaDb, added, removed, args.seed, args.control)
+        opcodes = [opcode for opcode in opcodes if opcode in selected]
+        sample = {opcode: indexes for opcode, indexes in selected.items() if indexes is not None}
+        changed = [opcode for opcode in opcodes if opcode not in control]
+        print(f"Found {sum(len(lines) for lines in added.values())} xda lines added and {sum(len(lines) for lines in removed.values())} "
+              f"removed since {args.changed_from} in {len(changed)} opcodes: {' '.join(changed)}")
+        print(f"Operand classes affected: {' '.join(operand_classes)}")
+        print(f"Control sample of {len(control)} unchanged opcodes with seed {args.seed}: {' '.join(control)}")
+    units = GetGroupUnits(opcodes, args.group)
+    if args.shard:
+        units = [unit for unit in units if GetShard(unit, args.shard[1]) == args.shard[0]]
+        print(f"Generating shard {args.shard[0]}/{args.shard[1]} with {len(units)} of {len(GetGroupUnits(opcodes, args.group))} units")
+    tasks = [(unit, GetPrevious(unit)) for unit in units]
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    if jobs > 1:
+        # every opcode owns its own files and numbering, so the shards never overlap and
+        # the result is identical to a serial run
+        pool = multiprocessing.Pool(jobs, InitWorker, (xdaDb, targets, args.batch, outputDir, args.group, opcodes, sample))
+        results = pool.imap(WriteTestFilesWorker, tasks, chunksize=4)
+    else:
+        results = ((unit, WriteTestFiles(unit, xdaDb, targets, args.batch, outputDir, previous, args.group, opcodes, sample), None) for unit, previous in tasks)
+    new_manifests = {target: {"generator": generator_hash, "opcodes": {}} for target in targets}
+    def InShard(unit):
+        return not args.shard or GetShard(unit, args.shard[1]) == args.shard[0]
+    for opcode, (count, entries), stats in results:
+        if stats:
+            MergeStats(stats)
+        for target in targets:
+            new_manifests[target]["opcodes"][opcode] = entries[target]
+        print (f"Generated {'/'.join(target_names[target].upper() for target in targets)} test files for opcode '{opcode}' with {count} instructions\n")
+    if jobs > 1:
+        pool.close()
+        pool.join()
+
+    for target in targets:
+        if args.incremental:
+            # opcodes which are gone from the xda file or blacklisted now
+            for opcode, entry in manifests[target]["opcodes"].items():
+                if opcode not in new_manifests[target]["opcodes"] and not InShard(opcode):
+                    # a unit of another shard sharing the directory, left as it is
+                    new_manifests[target]["opcodes"][opcode] = entry
+                elif opcode not in new_manifests[target]["opcodes"]:
+                    print(f"Removing stale {target_names[target].upper()} test files for opcode '{opcode}'")
+                    RemoveTestFiles(outputDir, target, entry["files"])
+                    Count("units_removed")
+        SaveManifest(outputDir, target, new_manifests[target])
+    WriteStats(f"gen_{args.target}", args.stats, args.trace)
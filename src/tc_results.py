@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import argparse
+
+from baseline import SaveBaseline
+from results_db import (RESULTS_DB, OpenDatabase, LoadFamilyIndex, RecordRun, GetRuns, SelectRuns, QueryResults, WriteJUnit,
+                        GetPreviousRun, GetRunFailures, CompareRuns)
+
+def PrintRows(rows: list, verbose: bool = False):
+    for row in rows:
+        rules = f" (normalized by {row['rules']})" if row["rules"] else ""
+        print(f"{row['run_id']}\t{row['status']}\t{row['family'] or '-'}\t{row['test']}\t{row['source_nasm'] or ''}{rules}")
+        if verbose and row["status"] == "fail":
+            print("\n".join(f"\t- {line}" for line in row["expected"].splitlines()))
+            print("\n".join(f"\t+ {line}" for line in row["actual"].splitlines()))
+
+def main():
+    parser = argparse.ArgumentParser(description='Record and query the check results of every run.')
+    parser.add_argument("--db", type=str, default=RESULTS_DB, help="The SQLite result database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record = subparsers.add_parser("import", help="Record a results file written by tc_check.py --results as a run")
+    record.add_argument("results", type=str, help="The results JSON file")
+    record.add_argument("--src-dir", "-s", type=str, default="target_src", help="Directory of the generated sources, for the ISA families")
+    record.add_argument("--label", type=str, help="Label of the run, e.g. the nasm commit")
+    runs = subparsers.add_parser("runs", help="List the recorded runs")
+    runs.add_argument("--mode", type=str, choices=["nasm", "gas", "sdm"], help="Only the runs of this check")
+    for name, description in (("query", "Print the results matching the filters"), ("junit", "Export the results of runs as JUnit XML")):
+        sub = subparsers.add_parser(name, help=description)
+        sub.add_argument("--run", type=str, default="last", help="Run id, the last run of every check by default")
+        sub.add_argument("--since", type=str, help="All runs started at or after this time, e.g. '2024-05-01 00:00'")
+        sub.add_argument("--mode", type=str, choices=["nasm", "gas", "sdm"], help="Only the runs of this check")
+    query = subparsers.choices["query"]
+    query.add_argument("--status", type=str, choices=["pass", "fail", "stale"], help="Only results with this status")
+    query.add_argument("--family", type=str, choices=["LEGACY", "VEX", "EVEX", "APX"], help="Only instructions of this ISA family")
+    query.add_argument("--opcode", type=str, help="Only opcodes matching this glob pattern")
+    query.add_argument("--test", type=str, help="Only test cases matching this glob pattern")
+    query.add_argument("--count", action="store_true", help="Print the number of matching results only")
+    query.add_argument("--json", action="store_true", help="Print the matching results as JSON lines")
+    query.add_argument("--verbose", "-v", action="store_true", help="Print the disassembly diff of failures")
+    junit = subparsers.choices["junit"]
+    junit.add_argument("--output", "-o", type=str, default="results.xml", help="The JUnit XML file to write")
+    diff = subparsers.add_parser("diff", help="Print the new failures, fixed tests and changed diffs of a run against an earlier one")
+    diff.add_argument("--run", type=int, help="Run id, the last run of the check by default")
+    diff.add_argument("--base", type=int, help="Run id to compare against, the run of the same check before it by default")
+    diff.add_argument("--mode", type=str, choices=["nasm", "gas", "sdm"], default="nasm", help="The check, when no run is given")
+    save = subparsers.add_parser("baseline", help="Write the failures of a run as a baseline for tc_check.py --baseline")
+    save.add_argument("--run", type=int, help="Run id, the last run of the check by default")
+    save.add_argument("--mode", type=str, choices=["nasm", "gas", "sdm"], default="nasm", help="The check, when no run is given")
+    save.add_argument("--output", "-o", type=str, required=True, help="The baseline file to write")
+    args = parser.parse_args()
+
+    conn = OpenDatabase(args.db)
+    if args.command == "import":
+        with open(args.results, 'r') as f:
+            results = json.load(f)
+        modes = {result["mode"] for result in results}
+        if len(modes) > 1:
+            print(f"Error: {args.results} mixes the results of several checks", file=sys.stderr)
+            return 1
+        mode = modes.pop() if modes else "nasm"
+        run_id = RecordRun(conn, mode, results, LoadFamilyIndex(args.src_dir), args.label)
+        print(f"Recorded {len(results)} {mode} results as run {run_id} in {args.db}")
+    elif args.command == "runs":
+        for row in GetRuns(conn, args.mode):
+            label = f"\t{row['label']}" if row["label"] else ""
+            print(f"{row['id']}\t{row['started']}\t{row['mode']}\t{row['passed']} passed\t{row['failed']} failed\t{row['stale']} stale{label}")
+    elif args.command == "query":
+        rows = QueryResults(conn, SelectRuns(conn, args.run, args.since, args.mode), args.status, args.family, args.opcode, args.test)
+        if args.count:
+            print(len(rows))
+        elif args.json:
+            for row in rows:
+                print(json.dumps(dict(row)))
+        else:
+            PrintRows(rows, args.verbose)
+    elif args.command in ("diff", "baseline"):
+        run_id = args.run or (SelectRuns(conn, "last", None, args.mode) or [None])[0]
+        if run_id is None:
+            print(f"Error: no {args.mode} run recorded in {args.db}", file=sys.stderr)
+            return 1
+        if args.command == "baseline":
+            run = conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+            failures = GetRunFailures(conn, run_id)
+            SaveBaseline(args.output, run["mode"], failures, run["label"])
+            print(f"Wrote the baseline of {len(failures)} failures of run {run_id} to {args.output}")
+            return 0
+        base_id = args.base or GetPreviousRun(conn, run_id)
+        if base_id is None:
+            print(f"Error: no run to compare run {run_id} against", file=sys.stderr)
+            return 1
+        changes = CompareRuns(conn, base_id, run_id)
+        print(f"Run {run_id} against run {base_id}: {len(changes['new'])} new failures, {len(changes['fixed'])} fixed, "
+              f"{len(changes['changed'])} with a changed diff, {changes['known']} known failures")
+        for kind in ("new", "changed", "fixed"):
+            for test in changes[kind]:
+                print(f"{kind}\t{test}")
+    elif args.command == "junit":
+        run_ids = SelectRuns(conn, args.run, args.since, args.mode)
+        WriteJUnit(args.output, conn, run_ids)
+        print(f"Wrote the results of {len(run_ids)} runs to {args.output}")
+    conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
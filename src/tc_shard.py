@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import socket
+import hashlib
+import argparse
+import subprocess
+
+from work_queue import InitQueue, LoadConfig, ClaimTask, CompleteTask, RequeueStale, GetQueueStatus, LoadResults
+from results_db import OpenDatabase, LoadFamilyIndex, RecordRun
+from tc_build import GetAssemblerStamp
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def GetTaskName(shard: int):
+    return f"shard_{shard:04d}"
+
+def ResolveCommand(command: str):
+    # an assembler given by a relative path must still be found from the shard directories
+    words = shlex.split(command)
+    if os.sep in words[0] and os.path.exists(words[0]):
+        words[0] = os.path.abspath(words[0])
+    return " ".join(shlex.quote(word) for word in words)
+
+def GetShardStages(config: dict, task: dict):
+    # the gen/build/check pipeline of one shard, run in the shard's own directory
+    python = sys.executable
+    shard = f"{task['shard']}/{task['shards']}"
+    jobs = str(config["jobs"])
+    build = [python, os.path.join(SRC_DIR, "tc_build.py"), "--jobs", jobs]
+    check = [python, os.path.join(SRC_DIR, "tc_check.py"), "--jobs", jobs]
+    return [
+        ["gen",            [python, os.path.join(SRC_DIR, "tc_gen.py"), "--xdafile", config["xdafile"], "--batch", str(config["batch"]),
+                            "--group", config["group"], "--jobs", jobs, "--shard", shard, "--incremental"]],
+        ["build_nasm_ref", build + ["--toolchain", "nasm", "--assembler", config["nasm_ref"], "--output-dir", "output/nasm.ref"]],
+        ["build_nasm_cur", build + ["--toolchain", "nasm", "--assembler", config["nasm_cur"], "--output-dir", "output/nasm.cur"]],
+        ["build_gas",      build + ["--toolchain", "gas", "--assembler", config["gas"], "--output-dir", "output/gas"]],
+        ["check_nasm",     check + ["nasm", "--results", "check_nasm.json"]],
+        ["check_gas",      check + ["gas", "--results", "check_gas.json"]]
+    ]
+
+def RunShard(queueDir: str, config: dict, task: dict):
+    work_dir = os.path.join(queueDir, "work", GetTaskName(task["shard"]))
+    for name in ("nasm", "gas"):
+        os.makedirs(os.path.join(work_dir, "target_src", name), exist_ok=True)
+    stages = []
+    start = time.perf_counter()
+    for name, command in GetShardStages(config, task):
+        stage_start = time.perf_counter()
+        with open(os.path.join(work_dir, f"{name}.log"), 'w') as f:
+            returncode = subprocess.run(command, cwd=work_dir, stdout=f, stderr=subprocess.STDOUT).returncode
+        stages.append({"stage": name, "returncode": returncode, "seconds": time.perf_counter() - stage_start})
+        if returncode != 0:
+            break
+    return {"shard": task["shard"], "shards": task["shards"], "host": socket.gethostname(), "pid": os.getpid(),
+            "status": "ok" if all(stage["returncode"] == 0 for stage in stages) and len(stages) == 6 else "failed",
+            "seconds": time.perf_counter() - start, "stages": stages,
+            "results": {mode: os.path.join(work_dir, f"check_{mode}.json") for mode in ("nasm", "gas")},
+            "src_dir": os.path.join(work_dir, "target_src")}
+
+def RunWorker(queueDir: str, worker: str):
+    # pull shards until the queue is drained
+    config = LoadConfig(queueDir)
+    done = 0
+    while True:
+        claimed = ClaimTask(queueDir)
+        if claimed is None:
+            return done
+        name, task = claimed
+        print(f"{worker}: running {name}", flush=True)
+        result = RunShard(queueDir, config, task)
+        result["worker"] = worker
+        CompleteTask(queueDir, name, result)
+        print(f"{worker}: {name} {result['status']} in {result['seconds']:.2f}s", flush=True)
+        done += 1
+
+def NaturalKey(text: str):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', text)]
+
+def MergeResults(queueDir: str, outputDir: str, db: str = None, label: str = None):
+    # one report per check across all shards, in test order as if checked on one host
+    config = LoadConfig(queueDir)
+    shard_results = LoadResults(queueDir)
+    missing = [GetTaskName(shard) for shard in range(config["shards"]) if GetTaskName(shard) not in shard_results]
+    failed = [name for name, result in sorted(shard_results.items()) if result["status"] != "ok"]
+    os.makedirs(outputDir, exist_ok=True)
+    conn = OpenDatabase(db) if db else None
+    for mode in ("nasm", "gas"):
+        results = []
+        family_index = {}
+        for name, shard in sorted(shard_results.items()):
+            if os.path.exists(shard["results"][mode]):
+                with open(shard["results"][mode], 'r') as f:
+                    results += json.load(f)
+                if conn:
+                    family_index.update(LoadFamilyIndex(shard["src_dir"]))
+        results.sort(key=lambda result: NaturalKey(result["file"]))
+        path = os.path.join(outputDir, f"check_{mode}.json")
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=1)
+        passed = sum(1 for result in results if result["status"] == "pass")
+        failures = sum(1 for result in results if result["status"] == "fail")
+        print(f"{mode}: {passed} passed, {failures} failed across {len(shard_results)} shards, merged into {path}")
+        if conn:
+            run_id = RecordRun(conn, mode, results, family_index, label)
+            print(f"{mode}: recorded as run {run_id} in {db}")
+    if conn:
+        conn.close()
+    for name in failed:
+        stage = next(stage for stage in shard_results[name]["stages"] if stage["returncode"] != 0)
+        print(f"Shard {name} failed in {stage['stage']} on {shard_results[name]['worker']}, see {os.path.join(queueDir, 'work', name, stage['stage'] + '.log')}")
+    if missing:
+        print(f"Shards not done yet: {' '.join(missing)}")
+    return 0 if not missing and not failed else 1
+
+def main():
+    parser = argparse.ArgumentParser(description='Split the gen/build/check pipeline into shards pulled from a shared work queue.')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    init = subparsers.add_parser("init", help="Create the queue with one task per shard")
+    init.add_argument("--queue", "-q", type=str, required=True, help="The queue directory, shared by all hosts")
+    init.add_argument("--shards", "-n", type=int, required=True, help="Number of shards")
+    init.add_argument("--xdafile", "-i", type=str, default="../x86/insns.xda", help="The instruction database from nasm")
+    init.add_argument("--group", "-g", type=str, choices=["opcode", "family"], default="opcode", help="Shard by opcode hash or by ISA family")
+    init.add_argument("--batch", "-b", type=int, default=1, help="Number of instructions per test file")
+    init.add_argument("--jobs", "-j", type=int, default=0, help="Number of processes of every stage on a host, 0 uses all CPUs")
+    init.add_argument("--nasm-ref", type=str, default="nasm", help="The reference nasm")
+    init.add_argument("--nasm-cur", type=str, default="../nasm", help="The nasm under test")
+    init.add_argument("--gas", type=str, default="as", help="The GNU assembler")
+    worker = subparsers.add_parser("worker", help="Run shards from the queue until it is drained")
+    worker.add_argument("--queue", "-q", type=str, required=True, help="The queue directory")
+    worker.add_argument("--id", type=str, help="Name of the worker, host and pid by default")
+    run = subparsers.add_parser("run", help="Drain the queue with local worker processes standing in for hosts, then merge")
+    run.add_argument("--queue", "-q", type=str, required=True, help="The queue directory")
+    run.add_argument("--workers", "-w", type=int, default=2, help="Number of local workers")
+    for sub in (run, subparsers.add_parser("merge", help="Merge the results of all done shards into one report")):
+        sub.add_argument("--output-dir", "-o", type=str, default=".", help="Directory to write check_nasm.json and check_gas.json to")
+        sub.add_argument("--db", type=str, help="Also record the merged results in this result database")
+        sub.add_argument("--label", type=str, help="Label of the runs in the result database")
+    merge = subparsers.choices["merge"]
+    merge.add_argument("--queue", "-q", type=str, required=True, help="The queue directory")
+    requeue = subparsers.add_parser("requeue", help="Put back the shards claimed by workers which died")
+    requeue.add_argument("--queue", "-q", type=str, required=True, help="The queue directory")
+    requeue.add_argument("--older-than", type=float, default=3600, help="Seconds since the shard was claimed")
+    status = subparsers.add_parser("status", help="Print the state of every shard")
+    status.add_argument("--queue", "-q", type=str, required=True, help="The queue directory")
+    args = parser.parse_args()
+
+    if args.command == "init":
+        config = {"shards": args.shards, "xdafile": os.path.abspath(args.xdafile), "group": args.group, "batch": args.batch,
+                  "jobs": args.jobs, "nasm_ref": ResolveCommand(args.nasm_ref), "nasm_cur": ResolveCommand(args.nasm_cur),
+                  "gas": ResolveCommand(args.gas)}
+        # a rebuilt assembler or an edited xda file changes the config too, so the shards are run again
+        config["stamps"] = {name: GetAssemblerStamp(config[name]) for name in ("nasm_ref", "nasm_cur", "gas")}
+        with open(config["xdafile"], 'rb') as f:
+            config["xda_hash"] = hashlib.sha256(f.read()).hexdigest()
+        tasks = {GetTaskName(shard): {"shard": shard, "shards": args.shards} for shard in range(args.shards)}
+        queued = InitQueue(args.queue, config, tasks)
+        print(f"Queued {queued} of {args.shards} shards in {args.queue}")
+    elif args.command == "worker":
+        worker_id = args.id or f"{socket.gethostname()}-{os.getpid()}"
+        done = RunWorker(args.queue, worker_id)
+        print(f"{worker_id}: queue drained after {done} shards")
+    elif args.command == "run":
+        start = time.perf_counter()
+        workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker", "--queue", args.queue, "--id", f"worker{i}"])
+                   for i in range(args.workers)]
+        for proc in workers:
+            proc.wait()
+        print(f"{args.workers} workers drained {args.queue} in {time.perf_counter() - start:.2f}s")
+        return MergeResults(args.queue, args.output_dir, args.db, args.label)
+    elif args.command == "merge":
+        return MergeResults(args.queue, args.output_dir, args.db, args.label)
+    elif args.command == "requeue":
+        requeued = RequeueStale(args.queue, args.older_than)
+        print(f"Requeued {len(requeued)} shards{': ' + ' '.join(requeued) if requeued else ''}")
+    elif args.command == "status":
+        for state, names in GetQueueStatus(args.queue).items():
+            print(f"{state}: {len(names)}{'  ' + ' '.join(names) if names else ''}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+import multiprocessing
+
+from elf64 import ReadElfText
+from snapshot import WriteSnapshot, SnapshotReader
+from tc_check import check_modes, GetTestList, GetObjdumpFlags, GetSourceHash, DisassembleCases
+from instrument import Count, Timer, TakeStats, ResetStats, MergeStats, WriteStats
+
+# the check mode each reference toolchain serves and how to ask it for its version
+snapshot_toolchains = {
+    "nasm" : ["nasm", "nasm", "-v"],
+    "gas"  : ["gas",  "as",   "--version"]
+}
+
+def GetToolchainVersion(assembler: str, option: str):
+    proc = subprocess.run([assembler, option], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    first_line = proc.stdout.splitlines()[0] if proc.stdout else ""
+    match = re.search(r'version\s+(\S+)', first_line)
+    return match.group(1) if match else (first_line.split()[-1] if first_line.split() else "unknown")
+
+def GetSnapshotName(toolchain: str, version: str):
+    return f"{toolchain}-{re.sub(r'[^A-Za-z0-9._-]', '_', version)}.snap"
+
+def CreateEntry(task):
+    # the expected bytes and disassembly of one test built by the reference toolchain
+    mode, objectDir, srcDir, test = task
+    _, obj_suffix, _, src_dir, src_suffix = check_modes[mode]
+    obj = os.path.join(objectDir, f"test_{test}{obj_suffix}")
+    src = os.path.join(srcDir, src_dir, f"test_{test}{src_suffix}")
+    if not os.path.exists(src):
+        return test, None
+    entry = {"source": GetSourceHash(src), "flags": GetObjdumpFlags(mode, test)}
+    if not os.path.exists(obj):
+        # the reference toolchain rejected the test
+        entry["status"] = "failed"
+        return test, entry
+    text = ReadElfText(obj)
+    cases, _ = DisassembleCases(obj, text, mode, test)
+    entry.update(status="ok", data=text.data.hex(), symbols=text.symbols, cases=cases)
+    return test, entry
+
+def CreateEntryWorker(task):
+    with Timer("snapshot_entry", test=task[3]):
+        test, entry = CreateEntry(task)
+    return test, entry, TakeStats()
+
+def CreateSnapshot(toolchain: str, version: str, objectDir: str, srcDir: str, outputDir: str, jobs: int = 0):
+    mode = snapshot_toolchains[toolchain][0]
+    os.makedirs(outputDir, exist_ok=True)
+    path = os.path.join(outputDir, GetSnapshotName(toolchain, version))
+    tasks = [(mode, objectDir, srcDir, test) for test in GetTestList(os.path.join(srcDir, "nasm"))]
+    meta = {"toolchain": toolchain, "version": version, "mode": mode, "created": time.strftime("%Y-%m-%d %H:%M:%S")}
+    def GetEntries(results):
+        for test, entry, stats in results:
+            MergeStats(stats)
+            if entry is not None:
+                Count("snapshot_entries")
+                yield test, entry
+    with multiprocessing.Pool(jobs if jobs > 0 else os.cpu_count(), ResetStats) as pool:
+        count = WriteSnapshot(path, meta, GetEntries(pool.imap(CreateEntryWorker, tasks, chunksize=16)))
+    return path, count
+
+def main():
+    parser = argparse.ArgumentParser(description='Record the output of a reference toolchain into a snapshot file.')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    create = subparsers.add_parser("create", help="Snapshot the objects built by a reference toolchain")
+    create.add_argument("--toolchain", "-t", type=str, choices=list(snapshot_toolchains), required=True, help="The reference toolchain")
+    create.add_argument("--assembler", "-a", type=str, help="The assembler to take the version from, nasm or as by default")
+    create.add_argument("--version", "-v", type=str, help="The toolchain version, asked from the assembler by default")
+    create.add_argument("--objects", type=str, required=True, help="Directory of the objects built by the reference toolchain")
+    create.add_argument("--src-dir", "-s", type=str, default="target_src", help="Directory of the generated sources")
+    create.add_argument("--output-dir", "-o", type=str, default="snapshots", help="Directory to write the snapshot to")
+    create.add_argument("--jobs", "-j", type=int, default=0, help="Number of processes, 0 uses all CPUs")
+    create.add_argument("--stats", type=str, help="Write the counters and timers of the run to this JSON file")
+    create.add_argument("--trace", type=str, help="Write a Chrome trace of the run to this file")
+    info = subparsers.add_parser("info", help="Print what a snapshot holds")
+    info.add_argument("snapshot", type=str, help="The snapshot file")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        reader = SnapshotReader(args.snapshot)
+        print(f"{args.snapshot}: {reader.meta['toolchain']} {reader.meta['version']} for the {reader.meta['mode']} check, "
+              f"{len(reader.Tests())} tests, taken {reader.meta['created']}")
+        reader.Close()
+        return 0
+
+    version = args.version or GetToolchainVersion(args.assembler or snapshot_toolchains[args.toolchain][1],
+                                                  snapshot_toolchains[args.toolchain][2])
+    start = time.perf_counter()
+    path, count = CreateSnapshot(args.toolchain, version, args.objects, args.src_dir, args.output_dir, args.jobs)
+    print(f"Wrote {args.toolchain} {version} snapshot of {count} tests to {path} in {time.perf_counter() - start:.2f}s")
+    WriteStats(f"snapshot_{args.toolchain}", args.stats, args.trace)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
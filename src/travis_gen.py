@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# write the nasm travis test of the instructions which passed the gas cross check: the instructions
+# are assembled in batches to flat binaries, each ending with a table of the offsets of its case
+# labels, and the bytes of every instruction are sliced out by those offsets
+
+import os
+import re
+import sys
+import json
+import shlex
+import struct
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from tc_build import AssembleFile, error_line
+from results_db import GetOpcode
+from instrument import Count, Timer, WriteStats
+
+TRAVIS_HEADER = """;Testname=%s; Arguments=-fbin -o%s.bin -O0 -DSRC; Files=stdout stderr %s.bin
+
+%%macro testcase 2
+ %%ifdef BIN
+  db %%1
+ %%endif
+ %%ifdef SRC
+  %%2
+ %%endif
+%%endmacro
+
+
+bits 64
+
+"""
+
+# a reference to the label after a test case, its bytes depend on where the label ends up
+label_reference = re.compile(r'\bnear1\b|\bnear1_')
+# a relative branch to an immediate target, its displacement depends on the offset it is assembled
+# at, so like in the shell version it is assembled alone at offset 0
+relative_branch = re.compile(r'^(?:\{[^}]*\}\s*)*(?:J(?!MPABS)[A-Z]*|CALL|LOOP[A-Z]*|XBEGIN)\s+(?!far\b)'
+                             r'(?:(?:short|near|strict|word|dword|qword)\s+)*[-+]?(?:0x[0-9a-f]+|[0-9]+)\s*$', re.IGNORECASE)
+
+def LoadPassedCases(resultsFile: str, opcodes: list = None):
+    # (opcode, source) of every case which passed, in the order of the opcode list if one is given
+    with open(resultsFile, 'r') as f:
+        results = json.load(f)
+    cases = [(GetOpcode(result["test"]), result["source"].get("nasm", "")) for result in results if result["status"] == "pass"]
+    if opcodes is None:
+        return cases
+    order = {opcode: i for i, opcode in enumerate(opcodes)}
+    return sorted((case for case in cases if case[0] in order), key=lambda case: order[case[0]])
+
+def SplitUnits(cases: list, batch: int):
+    # consecutive cases in units of up to batch instructions, a relative branch in a unit of its own
+    units = [[]]
+    for case in cases:
+        if relative_branch.match(case[1].strip()):
+            units += [[case], []]
+        else:
+            if len(units[-1]) >= max(batch, 1):
+                units.append([])
+            units[-1].append(case)
+    return [unit for unit in units if unit]
+
+def WriteUnit(path: str, sources: list):
+    # case_<k> before every instruction, then the offsets of all of them and of the end
+    lines = ["        bits 64\n"]
+    for k, source in enumerate(sources):
+        lines += [f"case_{k}:\n", f"        {source}\n"]
+    lines.append("case_end:\n")
+    lines.append("        dd " + ", ".join([f"case_{k}" for k in range(len(sources))] + ["case_end"]) + "\n")
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+def AssembleUnit(assembler: str, tmpDir: str, unit: int, sources: list):
+    # the bytes of every instruction of a unit, None for those the assembler rejects; the errors
+    # point at the rejected lines, otherwise the unit is halved until they are found
+    src = os.path.join(tmpDir, f"unit_{unit}.asm")
+    out = os.path.join(tmpDir, f"unit_{unit}.bin")
+    WriteUnit(src, sources)
+    result = AssembleFile(shlex.split(assembler) + ["-f", "bin", src, "-o", out], src, out)
+    if result["status"] == "ok":
+        with open(out, 'rb') as f:
+            data = f.read()
+        table = len(data) - 4 * (len(sources) + 1)
+        offsets = struct.unpack(f"<{len(sources) + 1}I", data[table:])
+        return [data[offsets[k]:offsets[k + 1]] for k in range(len(sources))]
+    if len(sources) == 1:
+        return [None]
+    # line 1 is "bits 64", the instruction of case k is on line 2k + 3
+    failing = {(int(match.group(1)) - 3) // 2 for match in error_line.finditer(result["stderr"])}
+    failing = {k for k in failing if 0 <= k < len(sources)}
+    if failing:
+        rest = [k for k in range(len(sources)) if k not in failing]
+        encoded = AssembleUnit(assembler, tmpDir, unit, [sources[k] for k in rest]) if rest else []
+        data = dict(zip(rest, encoded))
+        return [data.get(k) for k in range(len(sources))]
+    half = len(sources) // 2
+    return AssembleUnit(assembler, tmpDir, unit, sources[:half]) + AssembleUnit(assembler, tmpDir, unit, sources[half:])
+
+def FormatTestCase(data: bytes, source: str):
+    # the line of the shell version: xxd -i bytes and the source, both padded to 76 columns
+    hex_bytes = ", ".join(f"0x{byte:02x}" for byte in data)
+    return f"testcase    {{ {hex_bytes:<76} }}, {{ {source:<76} }}\n"
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the nasm travis test of the instructions which passed the gas cross check.')
+    parser.add_argument("name", type=str, help="Name of the test, written to <name>.asm")
+    parser.add_argument("--results", "-r", type=str, default="check_gas.json", help="The results of the gas check, written by tc_check.py --results")
+    parser.add_argument("--insns", type=str, default="insns.list", help="File of the opcodes to include, one per line, all of them if it does not exist")
+    parser.add_argument("--assembler", "-a", type=str, default="../nasm", help="The nasm assembling the instructions to their bytes")
+    parser.add_argument("--batch", "-b", type=int, default=1000, help="Number of instructions per assembler run")
+    parser.add_argument("--jobs", "-j", type=int, default=0, help="Number of assembler processes running at once, 0 uses all CPUs")
+    parser.add_argument("--stats", type=str, help="Write the counters and timers of the run to this JSON file")
+    parser.add_argument("--trace", type=str, help="Write a Chrome trace of the run to this file")
+    args = parser.parse_args()
+
+    opcodes = None
+    if os.path.exists(args.insns):
+        with open(args.insns, 'r') as f:
+            opcodes = f.read().split()
+    cases = LoadPassedCases(args.results, opcodes)
+    skipped = [case for case in cases if label_reference.search(case[1])]
+    cases = [case for case in cases if not label_reference.search(case[1])]
+    units = SplitUnits(cases, args.batch)
+    print(f"Writing {len(cases)} instructions of {len(set(opcode for opcode, _ in cases))} opcodes in {len(units)} units to {args.name}.asm")
+
+    written, rejected = 0, []
+    with tempfile.TemporaryDirectory() as tmp_dir, ThreadPoolExecutor(args.jobs if args.jobs > 0 else os.cpu_count()) as executor, \
+         open(f"{args.name}.asm", 'w') as f:
+        f.write(TRAVIS_HEADER % (args.name, args.name, args.name))
+        with Timer("emit"):
+            encoded_units = executor.map(lambda k: AssembleUnit(args.assembler, tmp_dir, k, [source for _, source in units[k]]), range(len(units)))
+            # the units come back in order, so the file is written as they finish
+            for unit, encoded in zip(units, encoded_units):
+                for (opcode, source), data in zip(unit, encoded):
+                    if data is None:
+                        rejected.append(source)
+                        continue
+                    f.write(FormatTestCase(data, source))
+                    written += 1
+    Count("travis_cases_written", written)
+    Count("travis_cases_rejected", len(rejected))
+    for source in rejected:
+        print(f"Rejected by {args.assembler}: {source}")
+    print(f"{args.name}.asm: {written} test cases, {len(rejected)} rejected, {len(skipped)} skipped for referencing a label")
+    WriteStats("travis", args.stats, args.trace)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
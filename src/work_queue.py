@@ -0,0 +1,85 @@
+# work queue in a shared directory: a task is a JSON file which the worker taking it moves from
+# pending/ to claimed/, rename being atomic on one file system, and whose result it writes to done/;
+# any number of workers on any number of hosts sharing the directory pull from it
+#
+#   <queue>/config.json  pending/<task>.json  claimed/<task>.json  done/<task>.json  work/<task>/
+
+import os
+import json
+import time
+import shutil
+
+QUEUE_CONFIG = "config.json"
+
+def WriteJson(path: str, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp_path, path)
+
+def InitQueue(queueDir: str, config: dict, tasks: dict):
+    # tasks maps the task names to their JSON data, a task already done is not queued again unless
+    # the queue was set up with another config, whose tasks and results are all dropped
+    if os.path.exists(os.path.join(queueDir, QUEUE_CONFIG)) and LoadConfig(queueDir) != config:
+        for name in ("pending", "claimed", "done", "work"):
+            shutil.rmtree(os.path.join(queueDir, name), ignore_errors=True)
+    for name in ("pending", "claimed", "done"):
+        os.makedirs(os.path.join(queueDir, name), exist_ok=True)
+    WriteJson(os.path.join(queueDir, QUEUE_CONFIG), config)
+    queued = 0
+    for name, task in tasks.items():
+        if not os.path.exists(os.path.join(queueDir, "done", f"{name}.json")):
+            WriteJson(os.path.join(queueDir, "pending", f"{name}.json"), task)
+            queued += 1
+    return queued
+
+def LoadConfig(queueDir: str):
+    with open(os.path.join(queueDir, QUEUE_CONFIG), 'r') as f:
+        return json.load(f)
+
+def ClaimTask(queueDir: str):
+    # take the first pending task nobody else took first, None when the queue is drained
+    pending_dir = os.path.join(queueDir, "pending")
+    for entry in sorted(os.listdir(pending_dir)):
+        if not entry.endswith(".json"):
+            continue
+        claimed = os.path.join(queueDir, "claimed", entry)
+        try:
+            os.rename(os.path.join(pending_dir, entry), claimed)
+        except FileNotFoundError:
+            continue
+        os.utime(claimed)
+        with open(claimed, 'r') as f:
+            return entry[:-len(".json")], json.load(f)
+    return None
+
+def CompleteTask(queueDir: str, name: str, result: dict):
+    WriteJson(os.path.join(queueDir, "done", f"{name}.json"), result)
+    claimed = os.path.join(queueDir, "claimed", f"{name}.json")
+    if os.path.exists(claimed):
+        os.remove(claimed)
+
+def RequeueStale(queueDir: str, maxAge: float):
+    # put the tasks claimed longer ago than maxAge seconds back, their worker is presumed dead
+    claimed_dir = os.path.join(queueDir, "claimed")
+    requeued = []
+    for entry in os.listdir(claimed_dir):
+        path = os.path.join(claimed_dir, entry)
+        try:
+            if time.time() - os.path.getmtime(path) > maxAge:
+                os.rename(path, os.path.join(queueDir, "pending", entry))
+                requeued.append(entry[:-len(".json")])
+        except FileNotFoundError:
+            continue
+    return requeued
+
+def GetQueueStatus(queueDir: str):
+    return {name: sorted(entry[:-len(".json")] for entry in os.listdir(os.path.join(queueDir, name)) if entry.endswith(".json"))
+            for name in ("pending", "claimed", "done")}
+
+def LoadResults(queueDir: str):
+    results = {}
+    for name in GetQueueStatus(queueDir)["done"]:
+        with open(os.path.join(queueDir, "done", f"{name}.json"), 'r') as f:
+            results[name] = json.load(f)
+    return results